@@ -1,17 +1,33 @@
 import streamlit as st
 import anthropic
+import httpx
 import io
 import requests
 from scholarly import scholarly
 import json
+import jsonschema
 import re
 import uuid
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import copy
+import random
+import numpy as np
 import streamlit.components.v1 as components
-from collections import defaultdict
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from collections import defaultdict, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
 from docx import Document
 from io import BytesIO
 from difflib import SequenceMatcher
-from pdfminer.high_level import extract_text
+from pdf_ingest import extract_pdf_document_from_path, extract_pdf_body_from_path, estimate_text_tokens, PDF_DOCUMENT_VERSION
 from difflib import SequenceMatcher
 
 #연구계획서 ID 생성
@@ -20,6 +36,9 @@ def generate_research_id():
 
 #세션 상태 초기화
 def reset_session_state():
+    # 이 세션이 참조하던 PDF는 저장소에서 정리될 수 있도록 참조 해제
+    if st.session_state.get('pdf_handles'):
+        release_pdf_blobs()
     keys_to_keep = ['api_key', 'anthropic_client']
     for key in list(st.session_state.keys()):
         if key not in keys_to_keep:
@@ -32,11 +51,16 @@ if 'show_full_content' not in st.session_state:
 
 # 섹션 내용 저장
 def save_section_content(section, content):
+    save_research_section(st.session_state.current_research_id, section, content)
+    invalidate_speculative_drafts(section)
+
+# 지정한 연구계획서 ID의 섹션 내용 저장 (일괄 작업 결과 반영 등 현재 연구계획서가 아닌 경우에도 사용)
+def save_research_section(research_id, section, content):
     if 'research_data' not in st.session_state:
         st.session_state.research_data = {}
-    if st.session_state.current_research_id not in st.session_state.research_data:
-        st.session_state.research_data[st.session_state.current_research_id] = {}
-    st.session_state.research_data[st.session_state.current_research_id][section] = content
+    if research_id not in st.session_state.research_data:
+        st.session_state.research_data[research_id] = {}
+    st.session_state.research_data[research_id][section] = content
 
 # 섹션 내용 로드
 def load_section_content(section):
@@ -120,7 +144,7 @@ PREDEFINED_PROMPTS = {
     
     PDF 내용:
     {pdf_content}
-    (각 PDF 파일의 초록(abstract), 서론(introduction), 결론(conclusion) 섹션이 포함되어 있습니다.)
+    (각 PDF 파일에서 연구 목적과 키워드에 관련된 문단(passages)을 골라 원문 순서대로 포함했습니다. section은 문단이 속한 섹션(front: 제목/저자/초록이 있는 앞부분, abstract, introduction, conclusion 등)입니다.)
 
     한국 소속 저자 포함 여부:
     {korean_authors}
@@ -134,8 +158,8 @@ PREDEFINED_PROMPTS = {
     4. 각 문단의 내용이 명확히 구분되도록 작성해주세요.
     5. 두 번째 문단에서는 반드시 제공된 PDF 파일의 내용을 참고하여 설명해주세요.
     6. 두 번째 문단에서는 국내 연구 현황을 정확히 파악하여 설명해주세요. 한국 소속 저자의 연구가 있다면 반드시 포함시키세요.
-    7. 선행 연구 내용은 제공된 PDF 내용(초록, 서론, 결론)만을 사용하여 작성하세요. 추가적인 정보를 임의로 만들어내지 마세요.
-    8. 각 PDF 파일의 초록, 서론, 결론 내용을 적극적으로 활용하여 선행 연구를 요약하고 설명하세요.
+    7. 선행 연구 내용은 제공된 PDF 내용(각 PDF에서 발췌한 문단)만을 사용하여 작성하세요. 추가적인 정보를 임의로 만들어내지 마세요.
+    8. 각 PDF 파일에서 발췌한 문단 내용을 적극적으로 활용하여 선행 연구를 요약하고 설명하세요.
     9. 사용자가 입력한 추가 정보나 키워드를 적절히 반영하여 연구 배경을 보완하세요.
     10. 두 번째 문단에서 절대로 제공된 PDF 내용에 없는 저자나 연구를 언급하지 마세요. 확실하지 않은 정보는 포함하지 마세요.
     11. 인용 시 저자 이름을 사용하지 말고, "한 연구에서는", "이전 연구에서는" 등의 표현을 사용하세요. 각 인용에 각주 번호를 추가하세요.
@@ -326,16 +350,578 @@ RESEARCH_SECTIONS = [
     # 다른 섹션들은 나중에 추가할 예정입니다.
 ]
 
+# Anthropic 프롬프트 캐시 설정 (요청당 cache_control 구간은 최대 4개)
+PROMPT_CACHE_MAX_BREAKPOINTS = 4
+LLM_USAGE_LOG_SIZE = 20
+
+# 호출 위치별 모델 라우팅 (추출/파싱 등 가벼운 작업은 작은 모델, 본문 작성은 큰 모델)
+# 환경 변수 IRB_MODEL_ROUTES(JSON 문자열) 또는 IRB_MODEL_ROUTES_FILE(JSON 파일 경로)로 항목별 덮어쓰기 가능
+# 예: IRB_MODEL_ROUTES='{"metadata": {"model": "claude-3-5-sonnet-20241022", "timeout": 60}}'
+LARGE_MODEL = "claude-3-5-sonnet-20241022"
+SMALL_MODEL = "claude-3-5-haiku-20241022"
+
+DEFAULT_MODEL_ROUTES = {
+    "purpose": {"model": LARGE_MODEL, "max_tokens": 2000, "timeout": 120},
+    "background": {"model": LARGE_MODEL, "max_tokens": 2000, "timeout": 120},
+    "section_draft": {"model": LARGE_MODEL, "max_tokens": 2000, "timeout": 120},
+    "revision": {"model": LARGE_MODEL, "max_tokens": 1000, "timeout": 60},
+    "titles": {"model": SMALL_MODEL, "max_tokens": 1000, "timeout": 30},
+    "metadata": {"model": SMALL_MODEL, "max_tokens": 500, "timeout": 30},
+    "review": {"model": LARGE_MODEL, "max_tokens": 2000, "timeout": 120},
+    "key_check": {"model": SMALL_MODEL, "max_tokens": 0, "timeout": 10},
+    "token_count": {"model": LARGE_MODEL, "max_tokens": 0, "timeout": 10},
+}
+
+# 모델별 100만 토큰당 가격 (USD: 입력, 출력, 캐시 저장, 캐시 적중)
+MODEL_PRICING_PER_MTOK = {
+    LARGE_MODEL: {"input": 3.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30},
+    SMALL_MODEL: {"input": 0.80, "output": 4.00, "cache_write": 1.00, "cache_read": 0.08},
+}
+
+# 기본 라우팅 표에 환경 변수/설정 파일의 덮어쓰기 항목을 병합
+def load_model_routes():
+    routes = {name: dict(route) for name, route in DEFAULT_MODEL_ROUTES.items()}
+    overrides = {}
+    try:
+        routes_file = os.environ.get("IRB_MODEL_ROUTES_FILE")
+        if routes_file:
+            with open(routes_file, encoding="utf-8") as f:
+                overrides.update(json.load(f))
+        if os.environ.get("IRB_MODEL_ROUTES"):
+            overrides.update(json.loads(os.environ["IRB_MODEL_ROUTES"]))
+    except (OSError, ValueError) as e:
+        print(f"Error loading model routes, using defaults: {str(e)}")
+        overrides = {}
+    for name, override in overrides.items():
+        if name in routes and isinstance(override, dict):
+            routes[name].update(override)
+        else:
+            print(f"Unknown model route ignored: {name}")
+    return routes
+
+MODEL_ROUTES = load_model_routes()
+
+# LLM 응답 캐시 설정 (메모리 LRU + SQLite 디스크 저장소)
+LLM_CACHE_PATH = os.environ.get("IRB_LLM_CACHE_PATH", os.path.join(".cache", "llm_cache.sqlite3"))
+LLM_CACHE_MEMORY_ENTRIES = 256
+LLM_CACHE_DISK_ENTRIES = 5000
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# 프로세스 전체(모든 세션)에서 공유하는 캐시 저장소
+@st.cache_resource
+def get_llm_cache():
+    os.makedirs(os.path.dirname(LLM_CACHE_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS llm_cache ("
+        "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache (accessed_at)")
+    conn.commit()
+    return {"memory": OrderedDict(), "db": conn, "lock": threading.Lock()}
+
+# (모델, 시스템 프롬프트, 메시지, max_tokens)의 해시로 캐시 키 생성
+def make_llm_cache_key(model, system, messages, max_tokens, tools=None):
+    request = {"model": model, "system": system, "messages": messages, "max_tokens": max_tokens}
+    if tools:
+        request["tools"] = tools
+    payload = json.dumps(request, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def llm_cache_get(key):
+    cache = get_llm_cache()
+    now = time.time()
+    with cache["lock"]:
+        entry = cache["memory"].get(key)
+        if entry is not None:
+            value, created_at = entry
+            if now - created_at <= LLM_CACHE_TTL_SECONDS:
+                cache["memory"].move_to_end(key)
+                return value
+            del cache["memory"][key]
+
+        try:
+            row = cache["db"].execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > LLM_CACHE_TTL_SECONDS:
+                cache["db"].execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                cache["db"].commit()
+                return None
+            cache["db"].execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            cache["db"].commit()
+        except sqlite3.Error as e:
+            print(f"Error reading LLM cache: {str(e)}")
+            return None
+
+        _llm_memory_cache_put(cache, key, value, created_at)
+        return value
+
+def llm_cache_put(key, value):
+    cache = get_llm_cache()
+    now = time.time()
+    with cache["lock"]:
+        _llm_memory_cache_put(cache, key, value, now)
+        try:
+            cache["db"].execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            # TTL 만료 항목 및 용량 초과분(가장 오래 사용되지 않은 항목) 정리
+            cache["db"].execute("DELETE FROM llm_cache WHERE created_at < ?", (now - LLM_CACHE_TTL_SECONDS,))
+            cache["db"].execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (LLM_CACHE_DISK_ENTRIES,)
+            )
+            cache["db"].commit()
+        except sqlite3.Error as e:
+            print(f"Error writing LLM cache: {str(e)}")
+
+def _llm_memory_cache_put(cache, key, value, created_at):
+    cache["memory"][key] = (value, created_at)
+    cache["memory"].move_to_end(key)
+    while len(cache["memory"]) > LLM_CACHE_MEMORY_ENTRIES:
+        cache["memory"].popitem(last=False)
+
+# 캐시에 있으면 바로 반환, 없으면 fetch()로 생성 후 저장
+# (사이드바의 '새로 생성' 옵션이 켜져 있으면 캐시를 건너뛰고 새 응답을 받음)
+def cached_llm_text(model, system, messages, max_tokens, fetch, tools=None):
+    key = make_llm_cache_key(model, system, messages, max_tokens, tools)
+    if not st.session_state.get('bypass_llm_cache', False):
+        cached = llm_cache_get(key)
+        if cached is not None:
+            return cached
+    text = call_with_rate_limit(fetch, estimate_tokens(system) + estimate_tokens(messages))
+    if text:
+        llm_cache_put(key, text)
+    return text
+
+# 구조화된 출력(도구 호출)용 JSON 스키마
+PDF_METADATA_TOOL = {
+    "name": "submit_pdf_metadata",
+    "description": "학술 논문에서 추출한 서지 정보를 제출합니다.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "title": {"type": "string", "description": "논문 제목"},
+            "authors": {"type": "array", "items": {"type": "string"}, "maxItems": 3, "description": "저자 (최대 3명)"},
+            "affiliations": {"type": "array", "items": {"type": "string"}, "description": "저자 소속 기관"},
+            "year": {"type": "string", "description": "출판 연도"},
+            "is_korean": {"type": "boolean", "description": "한국 소속 저자 포함 여부"}
+        },
+        "required": ["title", "authors", "affiliations", "year", "is_korean"]
+    }
+}
+
+TITLE_OPTIONS_TOOL = {
+    "name": "submit_title_options",
+    "description": "연구 과제명 후보(영문/한글 제목 쌍)를 제출합니다.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "options": {
+                "type": "array",
+                "minItems": 1,
+                "maxItems": 3,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "english": {"type": "string", "minLength": 1, "description": "완전한 영문 제목"},
+                        "korean": {"type": "string", "minLength": 1, "description": "완전한 한글 제목"}
+                    },
+                    "required": ["english", "korean"]
+                }
+            }
+        },
+        "required": ["options"]
+    }
+}
+
+REVIEW_FEEDBACK_TOOL = {
+    "name": "submit_review_feedback",
+    "description": "연구계획서 검토 결과(수정 제안 목록)를 제출합니다. 수정이 필요 없으면 빈 목록을 제출합니다.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "suggestions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "section": {"type": "string", "description": "섹션 이름"},
+                        "reason": {"type": "string", "minLength": 1, "description": "수정 이유"},
+                        "original": {"type": "string", "description": "기존 문장 (그대로 인용)"},
+                        "suggestion": {"type": "string", "description": "수정 예시"}
+                    },
+                    "required": ["section", "reason", "original", "suggestion"]
+                }
+            }
+        },
+        "required": ["suggestions"]
+    }
+}
+
+# 도구 호출(tool use)로 JSON 스키마에 맞는 구조화된 결과를 요청
+# 스키마 검증을 통과한 결과만 캐시에 저장되며, 검증에 실패하면 예외 발생
+def request_structured_output(route, system, messages, tool, label):
+    tools = [tool]
+    request_options = {"system": system} if system else {}
+    model = MODEL_ROUTES[route]["model"]
+    max_tokens = MODEL_ROUTES[route]["max_tokens"]
+
+    def fetch():
+        started_at = time.monotonic()
+        response = st.session_state.anthropic_client.beta.prompt_caching.messages.create(
+            model=model,
+            max_tokens=max_tokens,
+            messages=messages,
+            tools=tools,
+            tool_choice={"type": "tool", "name": tool["name"]},
+            timeout=MODEL_ROUTES[route]["timeout"],
+            **request_options
+        )
+        record_llm_usage(label, response.usage, route, model, time.monotonic() - started_at)
+        for block in response.content:
+            if block.type == "tool_use" and block.name == tool["name"]:
+                jsonschema.validate(block.input, tool["input_schema"])
+                return json.dumps(block.input, ensure_ascii=False)
+        raise ValueError(f"{tool['name']} 도구 호출 결과가 응답에 없습니다.")
+
+    return json.loads(cached_llm_text(model, system, messages, max_tokens, fetch, tools=tools))
+
+# 참고문헌 메타데이터 추출 시 동시에 처리할 PDF 개수
+PDF_METADATA_MAX_WORKERS = 8
+
+# Anthropic 클라이언트 풀 설정 (모든 세션이 API 키별로 하나의 클라이언트와 HTTP 연결을 공유)
+ANTHROPIC_CLIENT_POOL_SIZE = 64
+ANTHROPIC_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=120.0)
+API_KEY_VALIDATION_TTL_SECONDS = 60 * 60
+
+# API 키별 요청 속도 제한 및 재시도 설정 (환경 변수로 조정 가능)
+RATE_LIMIT_REQUESTS_PER_MINUTE = int(os.environ.get("IRB_RATE_LIMIT_RPM", "50"))
+RATE_LIMIT_TOKENS_PER_MINUTE = int(os.environ.get("IRB_RATE_LIMIT_TPM", "40000"))
+LLM_MAX_RETRIES = int(os.environ.get("IRB_LLM_MAX_RETRIES", "5"))
+LLM_RETRY_BASE_DELAY_SECONDS = 1.0
+LLM_RETRY_MAX_DELAY_SECONDS = 60.0
+
+# 요청 전 대략적인 토큰 수 추정 (영문은 약 4자당 1토큰, 한글 등 비ASCII 문자는 1자당 약 1토큰)
+def estimate_tokens(value):
+    if value is None:
+        return 0
+    return estimate_text_tokens(value if isinstance(value, str) else json.dumps(value, ensure_ascii=False))
+
+# API 키는 그대로 캐시 키로 쓰지 않고 해시값으로만 구분
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+# LLM 전송 계층 설정 (실제 API 없이 성능 테스트/부하 테스트를 하기 위한 용도)
+# live: 실제 API 호출, record: 실제 API 응답을 카세트 파일로 기록,
+# replay: 기록된 카세트를 인위적인 지연 시간과 함께 재생, mock: 로컬 모의 Anthropic 서버 사용
+LLM_TRANSPORT_MODE = os.environ.get("IRB_LLM_TRANSPORT", "live")
+LLM_CASSETTE_DIR = os.environ.get("IRB_LLM_CASSETTE_DIR", os.path.join(".cache", "cassettes"))
+LLM_SYNTHETIC_LATENCY_SECONDS = float(os.environ.get("IRB_LLM_SYNTHETIC_LATENCY", "0"))
+LLM_SYNTHETIC_EVENTS_PER_SECOND = float(os.environ.get("IRB_LLM_SYNTHETIC_EVENTS_PER_SECOND", "0"))
+LLM_MOCK_SERVER_PORT = int(os.environ.get("IRB_LLM_MOCK_PORT", "0"))
+LLM_MOCK_OUTPUT_CHARS = int(os.environ.get("IRB_LLM_MOCK_OUTPUT_CHARS", "400"))
+LLM_MOCK_DELTA_CHARS = 8
+
+# 요청 본문(JSON 키 정렬)과 경로로 카세트 키 생성 (호스트와 무관하게 같은 요청이면 같은 키)
+def cassette_key(method, path, body):
+    try:
+        body_text = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False)
+    except ValueError:
+        body_text = body.decode("utf-8", "replace")
+    return hashlib.sha256(f"{method} {path}\n{body_text}".encode("utf-8")).hexdigest()
+
+def cassette_path(key):
+    return os.path.join(LLM_CASSETTE_DIR, f"{key}.json")
+
+# 스트리밍(SSE) 응답은 이벤트 단위로 나누어 설정된 속도로 흘려보냄
+def paced_chunks(body):
+    chunks = [chunk + b"\n\n" for chunk in body.split(b"\n\n") if chunk]
+    for chunk in chunks:
+        if LLM_SYNTHETIC_EVENTS_PER_SECOND > 0:
+            time.sleep(1 / LLM_SYNTHETIC_EVENTS_PER_SECOND)
+        yield chunk
+
+# record 모드: 실제 API로 보낸 요청/응답을 카세트 파일로 저장
+def make_recording_handler(live_transport):
+    def handle(request):
+        response = live_transport.handle_request(request)
+        body = response.read()
+        response.close()
+        # 본문은 이미 압축이 풀린 상태이므로 전송 관련 헤더는 제외하고 저장
+        headers = {
+            name: value for name, value in response.headers.items()
+            if name.lower() not in ("content-encoding", "content-length", "transfer-encoding", "connection")
+        }
+        cassette = {
+            "request": {"method": request.method, "path": request.url.path, "body": request.content.decode("utf-8", "replace")},
+            "response": {"status_code": response.status_code, "headers": headers, "body": body.decode("utf-8")},
+        }
+        os.makedirs(LLM_CASSETTE_DIR, exist_ok=True)
+        path = cassette_path(cassette_key(request.method, request.url.path, request.content))
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(cassette, f, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+        return httpx.Response(response.status_code, headers=headers, content=body)
+    return handle
+
+# replay 모드: 기록된 카세트를 찾아 응답 (없으면 재시도하지 않는 404 오류)
+def replay_llm_request(request):
+    path = cassette_path(cassette_key(request.method, request.url.path, request.content))
+    if not os.path.exists(path):
+        return httpx.Response(404, json={
+            "type": "error",
+            "error": {"type": "not_found_error", "message": f"기록된 카세트가 없습니다: {request.url.path}"}
+        })
+    with open(path, encoding="utf-8") as f:
+        recorded = json.load(f)["response"]
+    time.sleep(LLM_SYNTHETIC_LATENCY_SECONDS)
+    return httpx.Response(
+        recorded["status_code"],
+        headers=recorded["headers"],
+        content=paced_chunks(recorded["body"].encode("utf-8"))
+    )
+
+# 전송 모드에 맞는 HTTP 클라이언트 (live/mock 모드는 기본 전송 계층 사용)
+def build_llm_http_client():
+    if LLM_TRANSPORT_MODE == "record":
+        live_transport = httpx.HTTPTransport(limits=ANTHROPIC_HTTP_LIMITS)
+        return anthropic.DefaultHttpxClient(transport=httpx.MockTransport(make_recording_handler(live_transport)))
+    if LLM_TRANSPORT_MODE == "replay":
+        return anthropic.DefaultHttpxClient(transport=httpx.MockTransport(replay_llm_request))
+    return anthropic.DefaultHttpxClient(limits=ANTHROPIC_HTTP_LIMITS)
+
+# 도구 입력 스키마를 만족하는 모의 값 생성
+def mock_value_for_schema(schema):
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {name: mock_value_for_schema(prop) for name, prop in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        count = min(schema.get("minItems", 1), schema.get("maxItems", 1))
+        return [mock_value_for_schema(schema.get("items", {})) for _ in range(count)]
+    if schema_type == "boolean":
+        return False
+    if schema_type in ("integer", "number"):
+        return 0
+    return "모의 응답"
+
+# 모의 서버의 messages.create 응답 본문
+def build_mock_message(body):
+    tool_choice = body.get("tool_choice") or {}
+    if tool_choice.get("type") == "tool":
+        tool = next(tool for tool in body.get("tools", []) if tool["name"] == tool_choice["name"])
+        content = [{"type": "tool_use", "id": f"toolu_mock_{uuid.uuid4().hex[:12]}", "name": tool["name"], "input": mock_value_for_schema(tool["input_schema"])}]
+    else:
+        content = [{"type": "text", "text": ("모의 응답입니다. " * LLM_MOCK_OUTPUT_CHARS)[:LLM_MOCK_OUTPUT_CHARS]}]
+    return {
+        "id": f"msg_mock_{uuid.uuid4().hex[:12]}",
+        "type": "message",
+        "role": "assistant",
+        "model": body.get("model", ""),
+        "content": content,
+        "stop_reason": "tool_use" if tool_choice.get("type") == "tool" else "end_turn",
+        "stop_sequence": None,
+        "usage": {
+            "input_tokens": estimate_tokens(body.get("system")) + estimate_tokens(body.get("messages")),
+            "output_tokens": estimate_tokens(content),
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+        },
+    }
+
+# 모의 응답을 스트리밍(SSE) 이벤트 순서대로 변환
+def mock_stream_events(message):
+    text = message["content"][0].get("text", "")
+    yield "message_start", {"type": "message_start", "message": dict(message, content=[], usage=dict(message["usage"], output_tokens=1))}
+    yield "content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}
+    for start in range(0, len(text), LLM_MOCK_DELTA_CHARS):
+        yield "content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text[start:start + LLM_MOCK_DELTA_CHARS]}}
+    yield "content_block_stop", {"type": "content_block_stop", "index": 0}
+    yield "message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": message["usage"]["output_tokens"]}}
+    yield "message_stop", {"type": "message_stop"}
+
+# 로컬 모의 Anthropic 서버 요청 처리 (messages.create, 스트리밍, count_tokens)
+class MockAnthropicHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("content-length") or 0)) or b"{}")
+        path = urlparse(self.path).path
+        time.sleep(LLM_SYNTHETIC_LATENCY_SECONDS)
+        if path == "/v1/messages/count_tokens":
+            self.send_json(200, {"input_tokens": estimate_tokens(body.get("system")) + estimate_tokens(body.get("messages"))})
+        elif path == "/v1/messages":
+            message = build_mock_message(body)
+            if body.get("stream"):
+                self.send_stream(message)
+            else:
+                self.send_json(200, message)
+        else:
+            self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": f"모의 서버가 지원하지 않는 경로입니다: {path}"}})
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, message):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.end_headers()
+        for event, payload in mock_stream_events(message):
+            if LLM_SYNTHETIC_EVENTS_PER_SECOND > 0:
+                time.sleep(1 / LLM_SYNTHETIC_EVENTS_PER_SECOND)
+            self.wfile.write(f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+# 모의 서버는 프로세스당 하나만 띄우고 모든 세션이 공유
+@st.cache_resource(show_spinner=False)
+def get_mock_llm_server():
+    server = ThreadingHTTPServer(("127.0.0.1", LLM_MOCK_SERVER_PORT), MockAnthropicHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[LLM transport] mock Anthropic server listening on port {server.server_port}")
+    return f"http://127.0.0.1:{server.server_port}"
+
+# API 키별 공유 클라이언트 (keep-alive 연결 풀을 세션 간에 재사용)
+@st.cache_resource(max_entries=ANTHROPIC_CLIENT_POOL_SIZE, show_spinner=False)
+def get_shared_anthropic_client(key_hash, _api_key):
+    client_options = {"base_url": get_mock_llm_server()} if LLM_TRANSPORT_MODE == "mock" else {}
+    return anthropic.Anthropic(
+        api_key=_api_key,
+        http_client=build_llm_http_client(),
+        # 재시도는 call_with_rate_limit에서 한 곳으로 모아 처리
+        max_retries=0,
+        **client_options
+    )
+
+# 생성 호출 없이 토큰 카운트 요청으로 키 유효성 검사 (성공한 결과만 키 해시별로 캐시)
+@st.cache_data(ttl=API_KEY_VALIDATION_TTL_SECONDS, show_spinner=False)
+def validate_api_key(key_hash, _client):
+    call_with_rate_limit(
+        lambda: _client.beta.messages.count_tokens(
+            model=MODEL_ROUTES["key_check"]["model"],
+            messages=[{"role": "user", "content": "Hello"}],
+            betas=["token-counting-2024-11-01"],
+            timeout=MODEL_ROUTES["key_check"]["timeout"]
+        ),
+        key_hash=key_hash
+    )
+    return True
+
+# API 키별 요청 속도 제한기 (분당 요청 수 / 분당 입력 토큰 수 토큰 버킷, 모든 세션이 공유)
+@st.cache_resource(max_entries=ANTHROPIC_CLIENT_POOL_SIZE, show_spinner=False)
+def get_rate_limiter(key_hash):
+    now = time.time()
+    return {
+        "lock": threading.Lock(),
+        "requests": {"capacity": float(RATE_LIMIT_REQUESTS_PER_MINUTE), "tokens": float(RATE_LIMIT_REQUESTS_PER_MINUTE), "updated_at": now},
+        "input_tokens": {"capacity": float(RATE_LIMIT_TOKENS_PER_MINUTE), "tokens": float(RATE_LIMIT_TOKENS_PER_MINUTE), "updated_at": now},
+        "blocked_until": 0.0,
+    }
+
+def _refill_bucket(bucket, now):
+    elapsed = now - bucket["updated_at"]
+    bucket["tokens"] = min(bucket["capacity"], bucket["tokens"] + elapsed * bucket["capacity"] / 60)
+    bucket["updated_at"] = now
+
+# 요청 1건과 예상 입력 토큰만큼의 여유가 생길 때까지 대기 (한도에 가까우면 요청을 줄 세움)
+def acquire_rate_limit(key_hash, estimated_tokens):
+    limiter = get_rate_limiter(key_hash)
+    cost = min(float(estimated_tokens), limiter["input_tokens"]["capacity"])
+    while True:
+        with limiter["lock"]:
+            now = time.time()
+            _refill_bucket(limiter["requests"], now)
+            _refill_bucket(limiter["input_tokens"], now)
+            request_wait = (1 - limiter["requests"]["tokens"]) * 60 / limiter["requests"]["capacity"]
+            token_wait = (cost - limiter["input_tokens"]["tokens"]) * 60 / limiter["input_tokens"]["capacity"]
+            wait_seconds = max(limiter["blocked_until"] - now, request_wait, token_wait, 0)
+            if wait_seconds <= 0:
+                limiter["requests"]["tokens"] -= 1
+                limiter["input_tokens"]["tokens"] -= cost
+                return
+        time.sleep(min(wait_seconds, 1.0))
+
+# retry-after 헤더 값(초)을 읽어옴
+def get_retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+# 429(요청 한도 초과), 529(서버 과부하) 등 일시적인 오류인지 확인
+def is_retryable_llm_error(error):
+    if isinstance(error, (anthropic.RateLimitError, anthropic.APIConnectionError)):
+        return True
+    return isinstance(error, anthropic.APIStatusError) and error.status_code >= 500
+
+# 모든 Claude 호출이 거치는 스케줄러: 속도 제한 대기 후 호출하고, 일시적인 오류는 지터가 포함된 지수 백오프로 재시도
+def call_with_rate_limit(func, estimated_tokens=0, key_hash=None):
+    if key_hash is None:
+        key_hash = hash_api_key(st.session_state.get('api_key') or "")
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        acquire_rate_limit(key_hash, estimated_tokens)
+        try:
+            return func()
+        except anthropic.APIError as e:
+            if attempt >= LLM_MAX_RETRIES or not is_retryable_llm_error(e):
+                raise
+            delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY_SECONDS, LLM_RETRY_BASE_DELAY_SECONDS * (2 ** attempt)))
+            retry_after = get_retry_after_seconds(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if isinstance(e, anthropic.RateLimitError):
+                # 한도 초과 시 같은 키를 쓰는 다른 요청도 함께 대기
+                limiter = get_rate_limiter(key_hash)
+                with limiter["lock"]:
+                    limiter["blocked_until"] = max(limiter["blocked_until"], time.time() + delay)
+            print(f"Retrying Claude request in {delay:.1f}s after error: {str(e)}")
+            time.sleep(delay)
+
+# 작업 스레드에서도 st.session_state 등을 사용할 수 있도록 현재 스크립트 컨텍스트를 연결하여 실행
+def run_with_script_run_ctx(ctx, func, *args):
+    if ctx is not None:
+        add_script_run_ctx(threading.current_thread(), ctx)
+    return func(*args)
+
+# 여러 작업을 스레드 풀에서 동시에 실행하고 입력 순서대로 결과를 반환
+# 하나의 작업이 실패해도 나머지 결과에는 영향을 주지 않으며, 실패한 자리에는 default 값을 넣음
+def parallel_map(func, items, max_workers=4, default=None):
+    items = list(items)
+    if not items:
+        return []
+    ctx = get_script_run_ctx()
+
+    results = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [executor.submit(run_with_script_run_ctx, ctx, func, item) for item in items]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Error in parallel task: {str(e)}")
+                results.append(copy.deepcopy(default))
+    return results
+
 # Anthropic API 클라이언트 초기화 함수
 def initialize_anthropic_client(api_key):
     try:
-        client = anthropic.Client(api_key=api_key)
-        # 간단한 API 호출로 키 유효성 검사
-        client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=2000,
-            messages=[{"role": "user", "content": "Hello"}]
-        )
+        key_hash = hash_api_key(api_key)
+        client = get_shared_anthropic_client(key_hash, api_key)
+        validate_api_key(key_hash, client)
         return client
     except Exception as e:
         st.error(f"API 키 초기화 중 오류 발생: {str(e)}")
@@ -348,31 +934,251 @@ def reset_session():
     st.session_state.clear()
 
                 
-#AI 응답 생성 함수
-def generate_ai_response(prompt):
+# 이전 섹션 내용을 프롬프트 본문에 넣는 대신, 앞쪽의 캐시 가능한 블록을 참조하도록 하는 문구
+def section_context_reference(section):
+    return f"(앞서 제공된 '{section}' 섹션 내용 참조)"
+
+# 이전 섹션들의 내용을 RESEARCH_SECTIONS 순서대로 메시지 블록으로 구성 (프롬프트 캐시의 공통 접두부)
+def build_section_context_blocks(context_sections):
+    blocks = [{"type": "text", "text": "다음은 지금까지 작성된 연구계획서의 섹션별 내용입니다."}]
+    for section in RESEARCH_SECTIONS:
+        if section in context_sections:
+            blocks.append({"type": "text", "text": f"{section}:\n{load_section_content(section)}"})
+    return blocks
+
+# 시스템 프롬프트와 마지막 몇 개의 섹션 블록에 cache_control 구간을 지정
+# 섹션 N이 캐시한 접두부를 섹션 N+1 요청이 그대로 재사용할 수 있도록 각 섹션 경계마다 구간을 둠
+def apply_prompt_cache_breakpoints(system, blocks):
+    system_blocks = None
+    remaining = PROMPT_CACHE_MAX_BREAKPOINTS
+    if system:
+        system_blocks = [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+        remaining -= 1
+    cached_blocks = [dict(block) for block in blocks]
+    for block in cached_blocks[max(len(cached_blocks) - remaining, 0):]:
+        block["cache_control"] = {"type": "ephemeral"}
+    return system_blocks, cached_blocks
+
+# 사용량 기준 예상 비용 (USD, 가격표에 없는 모델은 0)
+def estimate_llm_cost(model, entry):
+    pricing = MODEL_PRICING_PER_MTOK.get(model)
+    if not pricing:
+        return 0.0
+    return (
+        entry["input_tokens"] * pricing["input"]
+        + entry["output_tokens"] * pricing["output"]
+        + entry["cache_creation_input_tokens"] * pricing["cache_write"]
+        + entry["cache_read_input_tokens"] * pricing["cache_read"]
+    ) / 1_000_000
+
+# 라우트별 호출 수, 누적 지연 시간, 누적 비용 집계
+def record_route_stats(route, model, entry, latency):
+    stats = st.session_state.setdefault('llm_route_stats', {})
+    route_stats = stats.setdefault(route, {"model": model, "calls": 0, "latency_seconds": 0.0, "cost_usd": 0.0})
+    route_stats["model"] = model
+    route_stats["calls"] += 1
+    route_stats["latency_seconds"] += latency
+    route_stats["cost_usd"] += estimate_llm_cost(model, entry)
+
+# 호출별 프롬프트 캐시 적중/미스 토큰 기록 (route가 주어지면 라우트별 지연 시간/비용도 집계)
+def record_llm_usage(label, usage, route=None, model=None, latency=None):
+    if usage is None:
+        return
+    entry = {
+        "label": label,
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+    }
+    if 'llm_usage_log' not in st.session_state:
+        st.session_state.llm_usage_log = []
+    st.session_state.llm_usage_log.append(entry)
+    del st.session_state.llm_usage_log[:-LLM_USAGE_LOG_SIZE]
+    if route:
+        record_route_stats(route, model, entry, latency)
+
+# 섹션 작성용 요청(시스템 프롬프트 + 이전 섹션 접두부 + 프롬프트) 구성
+def build_generation_request(prompt, context_sections=None):
+    system_prompt = f"{SYSTEM_PROMPT}\n\n추가 지시사항: 답변을 작성할 때 번호나 불렛 포인트를 사용하지 말고, 서술형으로 작성해주세요. 문단을 나누어 가독성 있게 작성하되, 전체적으로 하나의 연결된 글이 되도록 해주세요."
+    context_blocks = build_section_context_blocks(context_sections) if context_sections else []
+    system_blocks, context_blocks = apply_prompt_cache_breakpoints(system_prompt, context_blocks)
+    messages = [
+        {"role": "user", "content": context_blocks + [{"type": "text", "text": prompt}]}
+    ]
+    return system_blocks, messages
+
+# 연구 과제명 후보를 구조화된 출력으로 요청하여 "영문 제목\n한글 제목" 형식의 목록으로 반환
+def generate_title_options(prompt, context_sections=None, raise_errors=False):
+    try:
+        if not st.session_state.get('anthropic_client'):
+            raise RuntimeError("API 클라이언트가 초기화되지 않았습니다. API 키를 다시 확인해주세요.")
+        system_blocks, messages = build_generation_request(prompt, context_sections)
+        result = request_structured_output(
+            route="titles",
+            system=system_blocks,
+            messages=messages,
+            tool=TITLE_OPTIONS_TOOL,
+            label="7. 연구 과제명"
+        )
+        return [f"{option['english'].strip()}\n{option['korean'].strip()}" for option in result['options']]
+    except Exception as e:
+        if raise_errors:
+            raise
+        st.error(f"연구 과제명 생성 중 오류 발생: {str(e)}")
+        return []
+
+# 섹션 이름에 맞는 모델 라우트
+def section_route(section):
+    if section == "1. 연구 목적":
+        return "purpose"
+    if section == "2. 연구 배경":
+        return "background"
+    if section == "7. 연구 과제명":
+        return "titles"
+    return "section_draft"
+
+#AI 응답 생성 함수 (stream=True 이면 토큰이 도착하는 대로 화면에 표시하고, 완성된 전체 텍스트를 반환)
+# context_sections가 주어지면 해당 섹션 내용을 프롬프트 캐시 접두부로 앞에 붙여 전송
+# raise_errors=True 이면 오류 문구를 반환하는 대신 예외를 그대로 전달 (일괄 생성 등에서 사용)
+# route를 생략하면 현재 섹션에 맞는 모델 라우트를 사용
+# label은 사용량 기록에 쓸 섹션 이름 (생략하면 현재 섹션, 백그라운드 초안 생성처럼 다른 섹션을 만들 때 지정)
+def generate_ai_response(prompt, stream=True, context_sections=None, raise_errors=False, route=None, label=None):
     if 'anthropic_client' in st.session_state and st.session_state.anthropic_client:
         try:
-            system_prompt = f"{SYSTEM_PROMPT}\n\n추가 지시사항: 답변을 작성할 때 번호나 불렛 포인트를 사용하지 말고, 서술형으로 작성해주세요. 문단을 나누어 가독성 있게 작성하되, 전체적으로 하나의 연결된 글이 되도록 해주세요."
-            
-            response = st.session_state.anthropic_client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=2000,
-                system=system_prompt,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            return response.content[0].text
+            label = label or st.session_state.get('current_section', 'generate_ai_response')
+            route = route or section_route(label)
+            model = MODEL_ROUTES[route]["model"]
+            max_tokens = MODEL_ROUTES[route]["max_tokens"]
+            timeout = MODEL_ROUTES[route]["timeout"]
+            system_blocks, messages = build_generation_request(prompt, context_sections)
+            caching_messages = st.session_state.anthropic_client.beta.prompt_caching.messages
+            # 재시도할 때 이전 시도에서 출력된 일부 응답이 남지 않도록 매번 같은 자리를 비우고 다시 출력
+            placeholder = st.empty() if stream else None
+
+            def fetch():
+                started_at = time.monotonic()
+                if stream:
+                    # 스트리밍 모드: 첫 토큰부터 바로 화면에 출력
+                    with caching_messages.stream(
+                        model=model,
+                        max_tokens=max_tokens,
+                        system=system_blocks,
+                        messages=messages,
+                        timeout=timeout
+                    ) as response_stream, placeholder.container():
+                        text = st.write_stream(response_stream.text_stream)
+                        record_llm_usage(label, response_stream.get_final_message().usage, route, model, time.monotonic() - started_at)
+                        return text
+
+                response = caching_messages.create(
+                    model=model,
+                    max_tokens=max_tokens,
+                    system=system_blocks,
+                    messages=messages,
+                    timeout=timeout
+                )
+                record_llm_usage(label, response.usage, route, model, time.monotonic() - started_at)
+                return response.content[0].text
+
+            return cached_llm_text(model, system_blocks, messages, max_tokens, fetch)
         except anthropic.APIError as e:
-            st.error(f"Anthropic API 오류: {str(e)}")
-            return f"AI 응답 생성 중 API 오류가 발생했습니다: {str(e)}"
+            if raise_errors:
+                raise
+            # 재시도 후에도 실패하면 오류 문구가 섹션 내용으로 저장되지 않도록 실행을 멈춤
+            st.error(f"Anthropic API 오류: {str(e)}\n\n잠시 후 다시 시도해주세요. 기존 내용은 그대로 유지됩니다.")
+            st.stop()
         except Exception as e:
+            if raise_errors:
+                raise
             st.error(f"예상치 못한 오류 발생: {str(e)}")
-            return f"AI 응답을 생성하는 중 예상치 못한 오류가 발생했습니다: {str(e)}"
+            st.stop()
     else:
+        if raise_errors:
+            raise RuntimeError("API 클라이언트가 초기화되지 않았습니다. API 키를 다시 확인해주세요.")
         return "API 클라이언트가 초기화되지 않았습니다. API 키를 다시 확인해주세요."
 
 
+# 수정 요청 시 섹션 전체를 다시 쓰는 대신 바꿀 구간만 편집 연산으로 받는 도구
+SECTION_EDITS_TOOL = {
+    "name": "submit_section_edits",
+    "description": "현재 섹션 내용에 적용할 편집 연산(구간 치환) 목록을 제출합니다. 전체를 다시 써야 하면 빈 목록을 제출합니다.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "edits": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "original": {"type": "string", "minLength": 1, "description": "현재 내용에서 바꿀 구간 (한 글자도 틀리지 않게 그대로 인용)"},
+                        "replacement": {"type": "string", "description": "해당 구간을 대신할 새 내용 (삭제 시 빈 문자열)"}
+                    },
+                    "required": ["original", "replacement"]
+                }
+            }
+        },
+        "required": ["edits"]
+    }
+}
+
+SECTION_EDIT_INSTRUCTION = """
+
+위 지침을 모두 지키되, 수정된 전체 내용을 다시 작성하지 말고 submit_section_edits 도구로 바꿀 구간만 제출하세요.
+- original에는 현재 내용에서 바꿀 구간을 공백과 문장부호까지 그대로 인용하세요. 각 구간은 현재 내용에서 한 번만 나타나야 하며, 구간끼리 겹치면 안 됩니다.
+- replacement에는 그 구간을 대신할 새 내용을 작성하세요. 구간을 삭제하려면 빈 문자열을 사용하세요.
+- 수정 요청을 반영하려면 내용 대부분을 다시 써야 하는 경우에는 edits를 빈 목록으로 제출하세요.
+"""
+
+# 편집 연산(구간 치환)을 현재 내용에 적용
+# 인용 구간이 없거나, 여러 번 나타나거나, 서로 겹치면 ValueError 발생
+def apply_section_edits(content, edits):
+    spans = []
+    for edit in edits:
+        original = edit['original']
+        start = content.find(original)
+        if start < 0:
+            raise ValueError(f"현재 내용에서 수정할 구간을 찾을 수 없습니다: {original[:30]}")
+        if content.find(original, start + 1) >= 0:
+            raise ValueError(f"수정할 구간이 여러 번 나타납니다: {original[:30]}")
+        spans.append((start, start + len(original), edit['replacement']))
+
+    spans.sort(key=lambda span: span[0])
+    for previous, current in zip(spans, spans[1:]):
+        if current[0] < previous[1]:
+            raise ValueError("수정할 구간이 서로 겹칩니다.")
+
+    pieces = []
+    position = 0
+    for start, end, replacement in spans:
+        pieces.append(content[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(content[position:])
+    return "".join(pieces)
+
+# 수정 요청 처리: 먼저 편집 연산만 받아 로컬에서 적용하고,
+# 편집 연산이 비었거나 적용에 실패하면 기존 전체 재작성 프롬프트로 다시 생성
+# (사이드바의 '부분 수정 모드'를 끄면 항상 전체 재작성)
+def revise_section_content(section, current_content, prompt):
+    if current_content and st.session_state.get('diff_revision_mode', True) and st.session_state.get('anthropic_client'):
+        try:
+            system_blocks, messages = build_generation_request(prompt + SECTION_EDIT_INSTRUCTION)
+            with st.spinner("수정 사항을 반영하는 중..."):
+                result = request_structured_output(
+                    route="revision",
+                    system=system_blocks,
+                    messages=messages,
+                    tool=SECTION_EDITS_TOOL,
+                    label=f"{section} (부분 수정)"
+                )
+            if result['edits']:
+                return apply_section_edits(current_content, result['edits'])
+            print(f"{section}: 편집 연산이 비어 있어 전체 재작성으로 전환합니다.")
+        except Exception as e:
+            print(f"{section}: 편집 연산 적용 실패, 전체 재작성으로 전환합니다. ({str(e)})")
+    return generate_ai_response(prompt, route=section_route(section))
+
 # PDF 파일 업로드 함수
 def upload_pdf():
     uploaded_file = st.file_uploader("PDF 파일을 업로드하세요.", type="pdf")
@@ -380,53 +1186,586 @@ def upload_pdf():
         return extract_text_from_pdf(uploaded_file)
     return None
 
+# PDF 텍스트 캐시 설정 (파일 내용의 SHA-256 기준, 모든 세션이 공유, 전체 글자 수 기준으로 오래된 항목부터 제거)
+# 각 항목은 추출한 텍스트와 섹션 제목 색인을 함께 보관 (메모리에서 밀려나도 디스크 저장소에서 다시 읽음)
+PDF_TEXT_CACHE_MAX_CHARS = int(os.environ.get("IRB_PDF_TEXT_CACHE_MAX_CHARS", str(20_000_000)))
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_text_cache():
+    return {"entries": OrderedDict(), "chars": 0, "lock": threading.Lock()}
+
+# 업로드 파일의 바이트 (파일 위치를 바꾸지 않도록 가능하면 getvalue 사용)
+def read_pdf_bytes(pdf_file):
+    if hasattr(pdf_file, "getvalue"):
+        return pdf_file.getvalue()
+    pdf_file.seek(0)
+    return pdf_file.read()
+
+def pdf_text_cache_get(key):
+    cache = get_pdf_text_cache()
+    with cache["lock"]:
+        text = cache["entries"].get(key)
+        if text is not None:
+            cache["entries"].move_to_end(key)
+        return text
+
+def pdf_text_cache_discard(key):
+    cache = get_pdf_text_cache()
+    with cache["lock"]:
+        if key in cache["entries"]:
+            cache["chars"] -= len(cache["entries"].pop(key)["text"])
+
+def pdf_text_cache_put(key, document):
+    cache = get_pdf_text_cache()
+    with cache["lock"]:
+        if key in cache["entries"]:
+            cache["chars"] -= len(cache["entries"].pop(key)["text"])
+        cache["entries"][key] = document
+        cache["chars"] += len(document["text"])
+        while cache["chars"] > PDF_TEXT_CACHE_MAX_CHARS and len(cache["entries"]) > 1:
+            _, evicted = cache["entries"].popitem(last=False)
+            cache["chars"] -= len(evicted["text"])
+
+# PDF 디스크 저장소 설정 (내용 해시별로 원본 PDF와 추출 결과를 한 번만 저장)
+# 세션 상태에는 {"hash", "name"} 핸들만 두고, 파싱할 때는 원본을 mmap으로 열어 읽음
+# 어느 세션도 참조하지 않는 파일은 전체 용량이 한도를 넘을 때 오래 사용하지 않은 것부터 삭제
+PDF_BLOB_DIR = os.environ.get("IRB_PDF_BLOB_DIR", os.path.join(".cache", "pdf_blobs"))
+PDF_BLOB_MAX_BYTES = int(os.environ.get("IRB_PDF_BLOB_MAX_BYTES", str(2 * 1024 ** 3)))
+
+# 저장소 참조 정보 (해시별로 참조 중인 세션 ID 집합, 모든 세션이 공유)
+@st.cache_resource(show_spinner=False)
+def get_pdf_blob_registry():
+    os.makedirs(PDF_BLOB_DIR, exist_ok=True)
+    return {"refs": defaultdict(set), "lock": threading.Lock()}
+
+def pdf_blob_path(key):
+    return os.path.join(PDF_BLOB_DIR, f"{key}.pdf")
+
+# 추출 결과 형식이 바뀌면 파일 이름이 달라져 다시 추출함
+def pdf_document_path(key):
+    return os.path.join(PDF_BLOB_DIR, f"{key}.v{PDF_DOCUMENT_VERSION}.json")
+
+# 전체 본문 추출 결과 (핵심 페이지 추출 결과와 따로 저장)
+def pdf_body_path(key):
+    return os.path.join(PDF_BLOB_DIR, f"{key}.v{PDF_DOCUMENT_VERSION}.body.json")
+
+# 임시 파일에 쓴 뒤 교체하여 다른 세션이 반쯤 쓰인 파일을 읽지 않도록 함
+def write_blob_file(path, data):
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+# 업로드 파일을 저장소에 넣고 세션 상태에 보관할 핸들 반환
+def store_pdf_blob(pdf_file):
+    get_pdf_blob_registry()
+    data = read_pdf_bytes(pdf_file)
+    key = hashlib.sha256(data).hexdigest()
+    if not os.path.exists(pdf_blob_path(key)):
+        write_blob_file(pdf_blob_path(key), data)
+        # 원본이 삭제된 뒤 남은 추출 결과(실패 기록 포함)는 버리고 다시 추출
+        for path in (pdf_document_path(key), pdf_body_path(key)):
+            if os.path.exists(path):
+                os.remove(path)
+        pdf_text_cache_discard(key)
+    return {"hash": key, "name": pdf_file.name}
+
+def save_pdf_document(key, document):
+    write_blob_file(pdf_document_path(key), json.dumps(document, ensure_ascii=False).encode("utf-8"))
+    pdf_text_cache_put(key, document)
+
+# 추출에 실패한 PDF의 기본값
+EMPTY_PDF_DOCUMENT = {"text": "", "headings": {}, "metadata": {}, "compaction": {}}
+
+# 추출에 실패한 PDF의 추출 결과 (실패도 저장해 두어 다시 실행할 때마다 파싱하지 않음)
+def failed_pdf_document(error):
+    document = dict(EMPTY_PDF_DOCUMENT)
+    document["error"] = str(error)
+    return document
+
+# 메모리 캐시 → 디스크에 저장된 추출 결과 순서로 찾음 (아직 추출하지 않았으면 None)
+def read_pdf_document(key):
+    document = pdf_text_cache_get(key)
+    if document is not None or not os.path.exists(pdf_document_path(key)):
+        return document
+    try:
+        with open(pdf_document_path(key), encoding="utf-8") as f:
+            document = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading extracted PDF {key[:12]}: {str(e)}")
+        return None
+    pdf_text_cache_put(key, document)
+    return document
+
+# 해시에 해당하는 PDF의 텍스트, 섹션 제목 색인, 로컬 서지 정보
+# 저장된 추출 결과가 없을 때만 ingest_pdfs로 파싱
+def load_pdf_document_by_hash(key):
+    document = read_pdf_document(key)
+    if document is None:
+        ingest_pdfs([{"hash": key, "name": key[:12]}])
+        document = read_pdf_document(key)
+    return document or EMPTY_PDF_DOCUMENT
+
+def is_pdf_document_ready(key):
+    return pdf_text_cache_get(key) is not None or os.path.exists(pdf_document_path(key))
+
+# 현재 프로세스에서 파싱하여 저장 (프로세스 풀을 쓸 수 없을 때 사용)
+def extract_pdf_document_in_process(key, name):
+    try:
+        document = extract_pdf_document_from_path(pdf_blob_path(key))
+    except Exception as e:
+        print(f"Error extracting text from {name}: {str(e)}")
+        document = failed_pdf_document(e)
+    save_pdf_document(key, document)
+
+# PDF 핸들({"hash", "name"}) 또는 업로드 파일에서 추출 결과를 가져옴 (같은 내용의 PDF는 다시 파싱하지 않음)
+# 전체 문서 대신 초록/서론이 있는 앞쪽 페이지와 결론이 있는 뒤쪽 페이지만 추출
+def load_pdf_document(pdf):
+    handle = pdf if isinstance(pdf, dict) else store_pdf_blob(pdf)
+    return load_pdf_document_by_hash(handle["hash"])
+
 # PDF에서 텍스트 추출 함수
 def extract_text_from_pdf(pdf_file):
+    return load_pdf_document(pdf_file)["text"]
+
+# 현재 세션에 업로드된 PDF들의 텍스트 (업로드 순서)
+def get_session_pdf_texts():
+    return [load_pdf_document_by_hash(handle["hash"])["text"] for handle in st.session_state.get('pdf_handles', [])]
+
+# PDF 텍스트 정리(머리글/바닥글, 하이픈, 공백)로 줄어든 토큰 수: (정리 전 합계, 정리 후 합계)
+def pdf_compaction_totals(pdf_handles):
+    original = compacted = 0
+    for handle in pdf_handles:
+        compaction = load_pdf_document_by_hash(handle["hash"]).get("compaction", {})
+        original += compaction.get("original_tokens", 0)
+        compacted += compaction.get("compacted_tokens", 0)
+    return original, compacted
+
+def current_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "default"
+
+# 현재 세션이 참조하는 PDF 목록을 갱신하고, 종료된 세션의 참조를 정리한 뒤 저장소 용량 확인
+def retain_pdf_blobs(keys):
+    registry = get_pdf_blob_registry()
+    session_id = current_session_id()
+    with registry["lock"]:
+        for refs in registry["refs"].values():
+            refs.discard(session_id)
+        for key in keys:
+            registry["refs"][key].add(session_id)
+    reclaim_pdf_blobs()
+
+def release_pdf_blobs():
+    retain_pdf_blobs([])
+
+def is_session_active(session_id):
     try:
-        # pdfminer를 사용하여 텍스트 추출
-        text = extract_text(pdf_file)
-        return text
+        from streamlit.runtime import Runtime
+        return Runtime.instance().is_active_session(session_id)
+    except Exception:
+        return True
+
+# 참조하는 세션이 없는 PDF를 오래 사용하지 않은 순서대로 삭제하여 전체 용량을 한도 이하로 유지
+def reclaim_pdf_blobs():
+    registry = get_pdf_blob_registry()
+    with registry["lock"]:
+        for key, refs in list(registry["refs"].items()):
+            refs.difference_update({session_id for session_id in refs if not is_session_active(session_id)})
+            if not refs:
+                del registry["refs"][key]
+        referenced = set(registry["refs"])
+
+        files = []
+        for name in os.listdir(PDF_BLOB_DIR):
+            if name.endswith((".pdf", ".json")):
+                path = os.path.join(PDF_BLOB_DIR, name)
+                stat = os.stat(path)
+                files.append((stat.st_atime, stat.st_size, name.split(".", 1)[0], path))
+        total = sum(size for _, size, _, _ in files)
+        for _, size, key, path in sorted(files):
+            if total <= PDF_BLOB_MAX_BYTES:
+                break
+            if key in referenced:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError as e:
+                print(f"Error removing PDF blob {path}: {str(e)}")
+
+# 업로드된 PDF 여러 개를 동시에 파싱할 작업 프로세스 수 (pdfminer는 CPU 작업이라 스레드 대신 프로세스 사용)
+PDF_INGEST_MAX_WORKERS = int(os.environ.get("IRB_PDF_INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# 모든 세션이 공유하는 PDF 파싱용 프로세스 풀
+# (Streamlit 서버는 여러 스레드를 쓰므로 fork 대신 spawn 방식으로 작업 프로세스 생성)
+@st.cache_resource(show_spinner=False)
+def get_pdf_process_pool():
+    return ProcessPoolExecutor(max_workers=PDF_INGEST_MAX_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+# 전체 본문 추출을 기다릴 최대 시간 (넘으면 핵심 페이지 추출 결과를 대신 사용)
+PDF_BODY_WAIT_SECONDS = float(os.environ.get("IRB_PDF_BODY_WAIT_SECONDS", "20"))
+
+# 진행 중인 전체 본문 추출 작업 (해시별 Future, 모든 세션이 공유하여 같은 PDF를 두 번 추출하지 않음)
+@st.cache_resource(show_spinner=False)
+def get_pdf_body_jobs():
+    return {"futures": {}, "lock": threading.Lock()}
+
+# 디스크에 저장된 전체 본문 추출 결과 (아직 추출하지 않았으면 None, 실패했으면 "error" 포함)
+def read_pdf_body(key):
+    if not os.path.exists(pdf_body_path(key)):
+        return None
+    try:
+        with open(pdf_body_path(key), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading extracted PDF body {key[:12]}: {str(e)}")
+        return None
+
+# 전체 본문 추출이 끝나면 결과를 저장 (작업 프로세스가 비정상 종료된 경우는 다음에 다시 시도하도록 저장하지 않음)
+def finish_pdf_body(jobs, key, future):
+    with jobs["lock"]:
+        jobs["futures"].pop(key, None)
+    try:
+        body = future.result()
+    except BrokenProcessPool as e:
+        print(f"PDF process pool failed while extracting body {key[:12]}: {str(e)}")
+        return
     except Exception as e:
-        print(f"Error extracting text from {pdf_file.name}: {str(e)}")
-        return ""
+        print(f"Error extracting PDF body {key[:12]}: {str(e)}")
+        body = {"text": "", "headings": {}, "error": str(e)}
+    write_blob_file(pdf_body_path(key), json.dumps(body, ensure_ascii=False).encode("utf-8"))
 
-# Google Scholar 검색 함수 수정
-def search_google_scholar(query, max_results=15):
-    search_query = scholarly.search_pubs(query)
-    results = defaultdict(list)
-    keywords = query.lower().split()
+# 전체 본문 추출을 프로세스 풀에 맡기고 Future 반환 (이미 저장되어 있으면 None)
+def schedule_pdf_body(key):
+    if os.path.exists(pdf_body_path(key)):
+        return None
+    jobs = get_pdf_body_jobs()
+    with jobs["lock"]:
+        future = jobs["futures"].get(key)
+        if future is None:
+            try:
+                future = get_pdf_process_pool().submit(extract_pdf_body_from_path, pdf_blob_path(key))
+            except BrokenProcessPool as e:
+                print(f"PDF process pool failed, skipping body extraction: {str(e)}")
+                get_pdf_process_pool.clear()
+                return None
+            jobs["futures"][key] = future
+            future.add_done_callback(lambda done: finish_pdf_body(jobs, key, done))
+    return future
+
+# 해시에 해당하는 PDF의 전체 본문과 섹션 제목 색인
+# 아직 추출 중이면 최대 timeout초까지 기다리고, 그래도 없거나 추출에 실패했으면 None
+def load_pdf_body_by_hash(key, timeout=PDF_BODY_WAIT_SECONDS):
+    body = read_pdf_body(key)
+    if body is None:
+        future = schedule_pdf_body(key)
+        if future is None:
+            return None
+        try:
+            body = future.result(timeout=timeout)
+        except Exception:
+            return None
+    return None if body.get("error") else body
+
+# 저장소에 넣은 PDF들을 프로세스 풀에서 동시에 파싱 (작업 프로세스에는 바이트 대신 파일 경로만 전달)
+# 이미 추출된 파일과 같은 내용의 중복 파일은 다시 파싱하지 않으며, 파일이 끝날 때마다 on_progress(완료 수, 전체 수, 파일 이름) 호출
+# 핵심 페이지 추출이 끝나면 전체 본문 추출은 기다리지 않고 백그라운드에서 시작
+def ingest_pdfs(pdf_handles, on_progress=None):
+    pending = {}
+    for handle in pdf_handles:
+        if handle["hash"] not in pending and not is_pdf_document_ready(handle["hash"]):
+            pending[handle["hash"]] = handle["name"]
+
+    total = len(pending)
+    if pending:
+        try:
+            pool = get_pdf_process_pool()
+            futures = {pool.submit(extract_pdf_document_from_path, pdf_blob_path(key)): (key, name) for key, name in pending.items()}
+            for done, future in enumerate(as_completed(futures), start=1):
+                key, name = futures[future]
+                try:
+                    document = future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    print(f"Error extracting text from {name}: {str(e)}")
+                    document = failed_pdf_document(e)
+                save_pdf_document(key, document)
+                if on_progress:
+                    on_progress(done, total, name)
+        except BrokenProcessPool as e:
+            # 작업 프로세스가 비정상 종료되면 풀을 새로 만들도록 비우고, 남은 파일은 현재 프로세스에서 처리
+            print(f"PDF process pool failed, extracting in-process: {str(e)}")
+            get_pdf_process_pool.clear()
+            for key, name in pending.items():
+                if not is_pdf_document_ready(key):
+                    extract_pdf_document_in_process(key, name)
+
+    for key in dict.fromkeys(handle["hash"] for handle in pdf_handles):
+        schedule_pdf_body(key)
+
+# Google Scholar 검색 설정
+# 전체 키워드를 합친 검색어와 키워드별 검색어를 동시에 실행하고, 제한 시간이 지나면 그때까지 받은 결과만 사용
+SCHOLAR_SEARCH_MAX_RESULTS = 15
+SCHOLAR_SEARCH_TIMEOUT_SECONDS = float(os.environ.get("IRB_SCHOLAR_SEARCH_TIMEOUT_SECONDS", "30"))
+SCHOLAR_SEARCH_MAX_WORKERS = int(os.environ.get("IRB_SCHOLAR_SEARCH_WORKERS", "8"))
+SCHOLAR_SEARCH_POLL_SECONDS = 1.0
+SCHOLAR_SEARCH_MESSAGES = {
+    "done": "검색이 완료되었습니다.",
+    "cached": "검색이 완료되었습니다. (최근에 같은 키워드로 검색한 결과를 사용했습니다.)",
+    "timeout": f"검색 제한 시간({int(SCHOLAR_SEARCH_TIMEOUT_SECONDS)}초)이 지나 그때까지 찾은 결과만 표시합니다.",
+    "cancelled": "검색을 중단했습니다. 그때까지 찾은 결과만 표시합니다.",
+    "error": "Google Scholar 검색 중 오류가 발생했습니다. 잠시 후 다시 시도해주세요.",
+}
 
-    for result in search_query:
-        if len(results['all_keywords']) + len(results['partial_keywords']) >= max_results:
-            break
+# Scholar 검색 결과 캐시 설정 (SQLite, 모든 세션이 공유)
+# 같은 키워드 조합(순서/대소문자/공백 무시)과 최대 결과 수로 검색하면 저장된 결과를 바로 사용
+# TTL이 지난 결과는 SCHOLAR_CACHE_STALE_SECONDS까지 그대로 보여주면서 백그라운드에서 다시 검색하여 갱신
+SCHOLAR_CACHE_PATH = os.environ.get("IRB_SCHOLAR_CACHE_PATH", os.path.join(".cache", "scholar_cache.sqlite3"))
+SCHOLAR_CACHE_TTL_SECONDS = int(os.environ.get("IRB_SCHOLAR_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+SCHOLAR_CACHE_STALE_SECONDS = int(os.environ.get("IRB_SCHOLAR_CACHE_STALE_SECONDS", str(14 * 24 * 60 * 60)))
+SCHOLAR_CACHE_MAX_ENTRIES = 2000
+
+@st.cache_resource
+def get_scholar_cache():
+    os.makedirs(os.path.dirname(SCHOLAR_CACHE_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(SCHOLAR_CACHE_PATH, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS scholar_cache ("
+        "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scholar_cache_accessed ON scholar_cache (accessed_at)")
+    conn.commit()
+    return {"db": conn, "lock": threading.Lock(), "refreshing": set()}
+
+# 키워드를 소문자/공백 정리 후 중복 제거, 정렬하여 최대 결과 수와 함께 캐시 키 생성
+def make_scholar_cache_key(keywords_list, max_results):
+    keywords = sorted({" ".join(keyword.lower().split()) for keyword in keywords_list} - {""})
+    payload = json.dumps({"keywords": keywords, "max_results": max_results}, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# 저장된 검색 결과와 저장 시각 반환 (없거나 SCHOLAR_CACHE_STALE_SECONDS보다 오래되었으면 None)
+def scholar_cache_get(key):
+    cache = get_scholar_cache()
+    now = time.time()
+    with cache["lock"]:
         try:
-            # 논문 여부 확인 로직
-            if not is_likely_paper(result):
-                continue
+            row = cache["db"].execute(
+                "SELECT value, created_at FROM scholar_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > SCHOLAR_CACHE_STALE_SECONDS:
+                cache["db"].execute("DELETE FROM scholar_cache WHERE key = ?", (key,))
+                cache["db"].commit()
+                return None
+            cache["db"].execute("UPDATE scholar_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            cache["db"].commit()
+        except sqlite3.Error as e:
+            print(f"Error reading Scholar cache: {str(e)}")
+            return None
+    return json.loads(value), created_at
+
+def scholar_cache_put(key, results):
+    cache = get_scholar_cache()
+    now = time.time()
+    with cache["lock"]:
+        try:
+            cache["db"].execute(
+                "INSERT OR REPLACE INTO scholar_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(results, ensure_ascii=False), now, now)
+            )
+            # 만료 항목 및 용량 초과분(가장 오래 사용되지 않은 항목) 정리
+            cache["db"].execute("DELETE FROM scholar_cache WHERE created_at < ?", (now - SCHOLAR_CACHE_STALE_SECONDS,))
+            cache["db"].execute(
+                "DELETE FROM scholar_cache WHERE key IN ("
+                "SELECT key FROM scholar_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (SCHOLAR_CACHE_MAX_ENTRIES,)
+            )
+            cache["db"].commit()
+        except sqlite3.Error as e:
+            print(f"Error writing Scholar cache: {str(e)}")
+
+# Scholar 검색용 스레드 풀 (모든 세션이 공유)
+# scholarly 요청은 중간에 끊을 수 없으므로, 중단/시간 초과된 작업은 다음 결과를 받는 시점에 종료됨
+@st.cache_resource(show_spinner=False)
+def get_scholar_search_executor():
+    return ThreadPoolExecutor(max_workers=SCHOLAR_SEARCH_MAX_WORKERS)
+
+# scholarly 검색 결과 하나를 화면 표시용 항목으로 변환 (논문이 아니면 None)
+def scholar_result_entry(result):
+    try:
+        # 논문 여부 확인 로직
+        if not is_likely_paper(result):
+            return None
+
+        title = result['bib'].get('title', 'No title')
+        year = result['bib'].get('pub_year', 'No year')
+        authors = result['bib'].get('author', 'No author')
+        if isinstance(authors, list):
+            authors = ", ".join(authors[:2]) + "..." if len(authors) > 2 else ", ".join(authors)
+        link = result.get('pub_url', '#')
+        return {"title": title, "year": year, "authors": authors, "link": link}
+    except AttributeError:
+        return None
 
-            title = result['bib'].get('title', 'No title')
-            year = result['bib'].get('pub_year', 'No year')
-            authors = result['bib'].get('author', 'No author')
-            if isinstance(authors, list):
-                authors = ", ".join(authors[:2]) + "..." if len(authors) > 2 else ", ".join(authors)
-            link = result.get('pub_url', '#')
-            
-            # 키워드 포함 여부 확인
-            title_lower = title.lower()
-            if all(keyword in title_lower for keyword in keywords):
-                results['all_keywords'].append({"title": title, "year": year, "authors": authors, "link": link})
-            elif any(keyword in title_lower for keyword in keywords):
-                results['partial_keywords'].append({"title": title, "year": year, "authors": authors, "link": link})
-        except AttributeError:
+# 검색어 하나의 결과를 차례로 받아 제목에 키워드가 하나 이상 포함된 논문만 job에 추가
+# max_results개를 모으면 종료. 중단 요청이나 제한 시간 초과로 끝나면 결과가 불완전하므로 캐시에 저장하지 않음
+def run_scholar_query(job, query):
+    found = 0
+    for result in scholarly.search_pubs(query):
+        if found >= job["max_results"]:
+            break
+        if job["cancel"].is_set() or time.time() > job["deadline"]:
+            job["complete"] = False
+            break
+        entry = scholar_result_entry(result)
+        if entry is None or not any(word in entry["title"].lower() for word in job["words"]):
             continue
+        found += 1
+        title_key = " ".join(entry["title"].lower().split())
+        with job["lock"]:
+            if title_key not in job["titles"]:
+                job["titles"].add(title_key)
+                job["entries"].append(entry)
+
+# 검색어 하나가 끝날 때마다 호출. 모든 검색어가 오류 없이 끝까지 완료되면 결과를 캐시에 저장
+def finish_scholar_query(job, future):
+    with job["lock"]:
+        job["pending"] -= 1
+        if future.cancelled() or future.exception() is not None:
+            job["complete"] = False
+        finished = job["pending"] == 0
+    if not finished:
+        return
+    if job["complete"]:
+        scholar_cache_put(job["cache_key"], scholar_search_results(job))
+    if job["refresh"]:
+        cache = get_scholar_cache()
+        with cache["lock"]:
+            cache["refreshing"].discard(job["cache_key"])
+
+# 검색 작업(job) 생성. refresh=True이면 캐시 갱신용 백그라운드 검색
+def new_scholar_search_job(keywords_list, max_results, timeout, cache_key, refresh=False):
+    return {
+        "keywords": list(keywords_list),
+        "words": " ".join(keywords_list).lower().split(),
+        "max_results": max_results,
+        "deadline": time.time() + timeout,
+        "cancel": threading.Event(),
+        "lock": threading.Lock(),
+        "titles": set(),
+        "entries": [],
+        "errors": [],
+        "futures": {},
+        "cache_key": cache_key,
+        "refresh": refresh,
+        "cached": False,
+        "complete": True,
+    }
+
+# 합친 검색어와 키워드별 검색어를 스레드 풀에 제출
+def submit_scholar_queries(job):
+    combined_query = " ".join(job["keywords"])
+    queries = list(dict.fromkeys([combined_query] + job["keywords"]))
+    job["pending"] = len(queries)
+    executor = get_scholar_search_executor()
+    job["futures"] = {executor.submit(run_scholar_query, job, query): query for query in queries}
+    for future in job["futures"]:
+        future.add_done_callback(lambda future, job=job: finish_scholar_query(job, future))
+
+# 키워드 검색 시작 (결과를 기다리지 않고 바로 job 반환)
+# job["entries"]에는 작업이 끝나는 대로 결과가 추가되며, scholar_search_results로 현재까지의 정렬된 결과를 가져옴
+# 캐시에 결과가 있으면 검색하지 않고 완료된 job을 반환하며, TTL이 지난 결과면 백그라운드에서 다시 검색하여 캐시 갱신
+def start_scholar_search(keywords_list, max_results=SCHOLAR_SEARCH_MAX_RESULTS, timeout=SCHOLAR_SEARCH_TIMEOUT_SECONDS):
+    cache_key = make_scholar_cache_key(keywords_list, max_results)
+    job = new_scholar_search_job(keywords_list, max_results, timeout, cache_key)
+    cached = scholar_cache_get(cache_key)
+    if cached is None:
+        submit_scholar_queries(job)
+        return job
+
+    results, created_at = cached
+    job["entries"] = results
+    job["cached"] = True
+    if time.time() - created_at > SCHOLAR_CACHE_TTL_SECONDS:
+        cache = get_scholar_cache()
+        with cache["lock"]:
+            refreshing = cache_key in cache["refreshing"]
+            cache["refreshing"].add(cache_key)
+        if not refreshing:
+            submit_scholar_queries(new_scholar_search_job(keywords_list, max_results, timeout, cache_key, refresh=True))
+    return job
+
+# 현재까지 받은 결과를 정렬해서 반환
+# 제목에 모든 키워드가 포함된 결과를 먼저, 그 다음 일부 키워드만 포함된 결과 (각 그룹은 최신 순)
+def scholar_search_results(job):
+    with job["lock"]:
+        entries = list(job["entries"])
+    results = defaultdict(list)
+    for entry in entries:
+        title_lower = entry["title"].lower()
+        group = 'all_keywords' if all(word in title_lower for word in job["words"]) else 'partial_keywords'
+        results[group].append(entry)
 
     # 각 그룹 내에서 최신 순으로 정렬
     for key in results:
         results[key].sort(key=lambda x: x['year'], reverse=True)
 
-    # 모든 키워드 포함 결과를 먼저, 그 다음 부분 키워드 포함 결과 반환
     final_results = results['all_keywords'] + results['partial_keywords']
-    return final_results[:max_results]
+    return final_results[:job["max_results"]]
+
+# 검색 상태: running, done, timeout, cancelled, error (모든 검색어가 오류로 끝난 경우)
+# 오류 내용은 job["errors"]에 (검색어, 오류 메시지)로 기록
+def scholar_search_state(job):
+    if job["cancel"].is_set():
+        return "cancelled"
+    failed_queries = [query for query, _ in job["errors"]]
+    for future, query in job["futures"].items():
+        if future.done() and future.exception() is not None and query not in failed_queries:
+            print(f"Error searching Google Scholar for '{query}': {str(future.exception())}")
+            job["errors"].append((query, str(future.exception())))
+    if all(future.done() for future in job["futures"]):
+        if job["futures"] and len(job["errors"]) == len(job["futures"]):
+            return "error"
+        return "done"
+    if time.time() > job["deadline"]:
+        return "timeout"
+    return "running"
+
+# 검색 중단 (대기 중인 검색어는 실행하지 않고, 실행 중인 검색어는 다음 결과를 받는 시점에 종료)
+def cancel_scholar_search(job):
+    job["cancel"].set()
+    for future in job["futures"]:
+        future.cancel()
+
+# 검색이 끝날 때까지 결과를 주기적으로 갱신하여 표시하고, 끝나면 결과를 scholar_results에 저장
+@st.fragment(run_every=SCHOLAR_SEARCH_POLL_SECONDS)
+def render_scholar_search_progress():
+    job = st.session_state.get('scholar_search')
+    if job is None:
+        return
+
+    state = scholar_search_state(job)
+    st.session_state.scholar_results = scholar_search_results(job)
+    if state == "running":
+        remaining = max(0, int(job["deadline"] - time.time()))
+        st.info(f"논문을 검색 중입니다... {len(st.session_state.scholar_results)}건 (최대 {remaining}초 남음)")
+        for result in st.session_state.scholar_results:
+            st.markdown(f"- [{result['title']} ({result['year']})]({result['link']})")
+        if st.button("검색 중단", key="cancel_scholar_search"):
+            cancel_scholar_search(job)
+            st.rerun()
+        return
+
+    if state == "timeout":
+        cancel_scholar_search(job)
+    del st.session_state.scholar_search
+    st.session_state.scholar_search_status = "cached" if job["cached"] else state
+    st.session_state.scholar_search_errors = job["errors"]
+    st.rerun()
 
 def is_likely_paper(result):
     # 논문일 가능성이 높은지 확인하는 함수
@@ -457,7 +1796,7 @@ def is_likely_paper(result):
     return False
 
 # 참고문헌 정리 함수 추가
-def format_references(scholar_results, pdf_files):
+def format_references(scholar_results, pdf_handles):
     references = []
     
     # Google Scholar 결과 처리
@@ -470,36 +1809,178 @@ def format_references(scholar_results, pdf_files):
         references.append(reference)
     
     # PDF 파일 처리
-    for i, pdf_file in enumerate(pdf_files, start=len(references)+1):
-        reference = f"{i}. {pdf_file.name}"
+    for i, pdf_handle in enumerate(pdf_handles, start=len(references)+1):
+        reference = f"{i}. {pdf_handle['name']}"
         references.append(reference)
     
     return references
 
-# PDF에서 특정 섹션 추출하는 함수 
-def extract_sections(text):
-    sections = {
-        'abstract': '',
-        'introduction': '',
-        'conclusion': ''
+# PDF 내용 토큰 예산 설정
+PDF_CONTENT_TOKEN_BUDGET = int(os.environ.get("IRB_PDF_CONTENT_TOKEN_BUDGET", "12000"))
+METADATA_SAMPLE_TOKEN_BUDGET = 1500
+# count_tokens API로 최종 프롬프트 토큰 수를 확인할지 여부 (기본값은 로컬 추정)
+USE_COUNT_TOKENS_API = os.environ.get("IRB_USE_COUNT_TOKENS_API", "") == "1"
+
+# 토큰 예산을 넘지 않도록 텍스트 앞부분만 남김
+def truncate_to_token_budget(text, budget):
+    if estimate_tokens(text) <= budget:
+        return text
+    used = 0.0
+    for i, ch in enumerate(text):
+        used += 1 if ord(ch) > 127 else 0.25
+        if used > budget:
+            return text[:i]
+    return text
+
+# 프롬프트 토큰 수 확인 (옵션이 켜져 있으면 count_tokens API, 아니면 로컬 추정값)
+def count_prompt_tokens(prompt):
+    if USE_COUNT_TOKENS_API and st.session_state.get('anthropic_client'):
+        try:
+            result = call_with_rate_limit(
+                lambda: st.session_state.anthropic_client.beta.messages.count_tokens(
+                    model=MODEL_ROUTES["token_count"]["model"],
+                    messages=[{"role": "user", "content": prompt}],
+                    betas=["token-counting-2024-11-01"],
+                    timeout=MODEL_ROUTES["token_count"]["timeout"]
+                )
+            )
+            return result.input_tokens
+        except anthropic.APIError as e:
+            print(f"Error counting tokens: {str(e)}")
+    return estimate_tokens(prompt)
+
+# PDF 문단 검색(BM25) 설정
+# 문단 하나의 최대 토큰 수, PDF당 가져올 최대 문단 수, 검색 색인을 메모리에 유지할 PDF 수
+PDF_PASSAGE_MAX_TOKENS = int(os.environ.get("IRB_PDF_PASSAGE_MAX_TOKENS", "200"))
+PDF_RETRIEVAL_TOP_K = int(os.environ.get("IRB_PDF_RETRIEVAL_TOP_K", "8"))
+PDF_RETRIEVAL_INDEX_MAX_ENTRIES = int(os.environ.get("IRB_PDF_RETRIEVAL_INDEX_MAX_ENTRIES", "256"))
+BM25_K1 = 1.5
+BM25_B = 0.75
+# 검색 대상에서 제외할 섹션 (인용 목록은 검색어와 겹쳐도 배경 작성에 쓸모가 없음)
+PDF_RETRIEVAL_EXCLUDED_SECTIONS = {"references"}
+RETRIEVAL_TERM_PATTERN = re.compile(r'[a-z0-9가-힣]{2,}')
+
+def retrieval_terms(text):
+    return RETRIEVAL_TERM_PATTERN.findall((text or "").lower())
+
+# 섹션 제목 색인을 원문 순서의 (시작, 끝, 섹션 이름) 목록으로 변환 (제목이 없으면 전체를 "front"로 봄)
+def section_spans(headings, length):
+    spans = sorted((start, end, name) for name, ranges in headings.items() for start, end in ranges)
+    return spans or [(0, length, "front")]
+
+# 문단을 문장 단위로 나눔 (문장 하나가 PDF_PASSAGE_MAX_TOKENS를 넘으면 단어 단위로 다시 나눔)
+def passage_units(block):
+    for sentence in re.split(r'(?<=[.!?])\s+', " ".join(block.split())):
+        if estimate_tokens(sentence) <= PDF_PASSAGE_MAX_TOKENS:
+            yield sentence
+            continue
+        words = []
+        for word in sentence.split(" "):
+            if words and estimate_tokens(" ".join(words + [word])) > PDF_PASSAGE_MAX_TOKENS:
+                yield " ".join(words)
+                words = []
+            words.append(word)
+        if words:
+            yield " ".join(words)
+
+# 텍스트를 문단 단위로 나누고, 긴 문단은 문장 단위로 PDF_PASSAGE_MAX_TOKENS 이하가 되도록 묶음
+# 반환값: [{"section": 섹션 이름, "text": 문단}, ...] (원문 순서)
+def split_pdf_passages(text, headings):
+    passages = []
+    # 문단은 섹션 제목과 페이지 구분(\x0c)을 넘지 않도록 섹션 구간 안에서만 나눔
+    blocks = (
+        (name, block)
+        for start, end, name in section_spans(headings, len(text)) if name not in PDF_RETRIEVAL_EXCLUDED_SECTIONS
+        for block in re.finditer(r'[^\s][^\n\x0c]*(?:\n(?![ \t]*\n)[^\n\x0c]*)*', text[start:end])
+    )
+    for section, block in blocks:
+        current = []
+        for sentence in passage_units(block.group()):
+            if current and estimate_tokens(" ".join(current + [sentence])) > PDF_PASSAGE_MAX_TOKENS:
+                passages.append({"section": section, "text": " ".join(current)})
+                current = []
+            current.append(sentence)
+        if current:
+            passages.append({"section": section, "text": " ".join(current)})
+    return [passage for passage in passages if retrieval_terms(passage["text"])]
+
+# PDF 하나의 BM25 색인 (파일 해시와 원본 종류별로 캐시, 모든 세션이 공유)
+# source가 "body"이면 전체 본문, "key_pages"이면 핵심 페이지(전체 본문 추출이 아직 끝나지 않았거나 실패한 경우)로 만듦
+# 문단별 BM25 가중치를 미리 계산해 두고 검색 시에는 검색어 열만 더함
+@st.cache_resource(show_spinner=False, max_entries=PDF_RETRIEVAL_INDEX_MAX_ENTRIES)
+def get_pdf_retrieval_index(key, source):
+    document = (load_pdf_body_by_hash(key, timeout=0) if source == "body" else None) or load_pdf_document_by_hash(key)
+    passages = split_pdf_passages(document["text"], document["headings"])
+    vocabulary = {}
+    rows, cols = [], []
+    for row, passage in enumerate(passages):
+        for term in retrieval_terms(passage["text"]):
+            rows.append(row)
+            cols.append(vocabulary.setdefault(term, len(vocabulary)))
+
+    term_frequency = np.zeros((len(passages), len(vocabulary)), dtype=np.float32)
+    np.add.at(term_frequency, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)), 1.0)
+    if passages:
+        lengths = term_frequency.sum(axis=1, keepdims=True)
+        document_frequency = (term_frequency > 0).sum(axis=0)
+        idf = np.log1p((len(passages) - document_frequency + 0.5) / (document_frequency + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / lengths.mean())
+        weights = (idf * term_frequency * (BM25_K1 + 1) / (term_frequency + norm)).astype(np.float32)
+    else:
+        weights = term_frequency
+    return {
+        "passages": passages,
+        "vocabulary": vocabulary,
+        "weights": weights,
+        "tokens": np.array([estimate_tokens(passage["text"]) for passage in passages], dtype=np.int64),
+    }
+
+# 검색어와 관련도가 높은 문단을 최대 top_k개, 토큰 예산 안에서 골라 원문 순서로 반환
+# 검색어와 겹치는 단어가 없으면 앞쪽 문단(제목, 초록)부터 사용
+def retrieve_pdf_passages(index, query, budget, top_k=PDF_RETRIEVAL_TOP_K):
+    columns = [index["vocabulary"][term] for term in set(retrieval_terms(query)) if term in index["vocabulary"]]
+    scores = index["weights"][:, columns].sum(axis=1) if columns else np.zeros(len(index["passages"]))
+    # 점수가 같으면 앞쪽 문단 우선
+    order = np.lexsort((np.arange(len(scores)), -scores))
+    keep = []
+    used = 0
+    for row in order:
+        if len(keep) >= top_k:
+            break
+        cost = int(index["tokens"][row])
+        if used + cost <= budget:
+            keep.append(row)
+            used += cost
+    return [index["passages"][row] for row in sorted(keep)], used
+
+# 업로드된 PDF들에서 검색어(연구 목적, 키워드 등)와 관련된 문단을 골라 PDF 내용 목록 생성
+# 방법/결과/고찰까지 검색하도록 전체 본문을 사용하고, 전체 본문이 준비되지 않았으면 핵심 페이지를 사용
+# PDF별로 토큰 예산을 나누고, 예산을 다 쓰지 않은 PDF의 남은 토큰은 다음 PDF에 넘겨줌
+# 결과는 st.session_state.pdf_token_report에 기록
+def build_pdf_contents(pdf_handles, query, total_budget):
+    indexes = [
+        get_pdf_retrieval_index(handle["hash"], "body" if load_pdf_body_by_hash(handle["hash"]) else "key_pages")
+        for handle in pdf_handles
+    ]
+    original_tokens = [int(index["tokens"].sum()) for index in indexes]
+    contents = [None] * len(pdf_handles)
+    sent_tokens = [0] * len(pdf_handles)
+
+    remaining_budget = total_budget
+    order = sorted(range(len(pdf_handles)), key=lambda i: original_tokens[i])
+    for position, i in enumerate(order):
+        budget = remaining_budget // (len(order) - position)
+        passages, sent_tokens[i] = retrieve_pdf_passages(indexes[i], query, budget)
+        contents[i] = {"file_name": pdf_handles[i]["name"], "passages": passages}
+        remaining_budget -= sent_tokens[i]
+
+    st.session_state.pdf_token_report = {
+        "files": [
+            {"file_name": handle["name"], "original_tokens": original_tokens[i], "sent_tokens": sent_tokens[i]}
+            for i, handle in enumerate(pdf_handles)
+        ]
     }
-    
-    # Abstract 추출
-    abstract_match = re.search(r'(?i)abstract.*?(?=\n\n|\n[A-Z])', text, re.DOTALL)
-    if abstract_match:
-        sections['abstract'] = abstract_match.group(0)
-    
-    # Introduction 추출
-    intro_match = re.search(r'(?i)introduction.*?(?=\n\n|\n[A-Z])', text, re.DOTALL)
-    if intro_match:
-        sections['introduction'] = intro_match.group(0)
-    
-    # Conclusion 추출
-    conclusion_match = re.search(r'(?i)conclusion.*?(?=\n\n|\n[A-Z]|$)', text, re.DOTALL)
-    if conclusion_match:
-        sections['conclusion'] = conclusion_match.group(0)
-    
-    return sections
+    return contents
 
 # 1. 연구목적 작성 함수
 def write_research_purpose():
@@ -521,7 +2002,7 @@ def write_research_purpose():
     
     if st.button("연구 목적 AI 생성 요청✍🏻"):
         if user_input:
-            prompt = PREDEFINED_PROMPTS["1. 연구 목적"].format(user_input=user_input)
+            prompt, _ = build_section_prompt("1. 연구 목적", user_input)
             ai_response = generate_ai_response(prompt)
             
             # 현재 내용을 히스토리에 추가
@@ -585,7 +2066,7 @@ def write_research_purpose():
                     
                     수정된 전체 연구 목적을 작성해주세요.
                     """
-                    modified_response = generate_ai_response(prompt)
+                    modified_response = revise_section_content("1. 연구 목적", current_content, prompt)
                     
                     save_section_content("1. 연구 목적", modified_response)
                     st.session_state.show_modification_request = False
@@ -621,6 +2102,83 @@ def write_research_purpose():
                 st.warning("더 이상 되돌릴 수 있는 버전이 없습니다.")
 
 
+# 섹션별 템플릿에서 이전 섹션 내용이 들어가는 자리의 이름
+SECTION_TEMPLATE_FIELDS = {
+    "1. 연구 목적": "research_purpose",
+    "2. 연구 배경": "research_background",
+    "3. 선정기준, 제외기준": "selection_criteria",
+    "4. 대상자 수 및 산출근거": "sample_size",
+    "5. 자료분석과 통계적 방법": "data_analysis",
+    "6. 연구방법": "research_method",
+}
+
+# 섹션 프롬프트와 프롬프트 캐시 접두부로 함께 보낼 이전 섹션 목록을 생성
+# (3번 이후 섹션은 이전 섹션 내용을 본문에 넣지 않고 앞쪽 블록을 참조하도록 작성)
+def build_section_prompt(section, user_input="", **template_values):
+    if section == "1. 연구 목적":
+        return PREDEFINED_PROMPTS[section].format(user_input=user_input), []
+    if section == "2. 연구 배경":
+        return build_research_background_prompt(user_input, template_values.get("keywords", "")), []
+
+    context_sections = RESEARCH_SECTIONS[:RESEARCH_SECTIONS.index(section)]
+    values = {
+        "total_subjects": "미입력",
+        "internal_subjects": "미입력",
+        "external_subjects": "미입력",
+    }
+    values.update(template_values)
+    for context_section in context_sections:
+        values[SECTION_TEMPLATE_FIELDS[context_section]] = section_context_reference(context_section)
+    return PREDEFINED_PROMPTS[section].format(user_input=user_input, **values), context_sections
+
+# 2. 연구 배경 프롬프트 생성 (업로드된 PDF에서 연구 목적/키워드와 관련된 문단과 참고문헌 정보 포함)
+def build_research_background_prompt(user_input, keywords=""):
+    research_purpose = load_section_content("1. 연구 목적")
+    
+    # PDF별 토큰 예산 안에서 연구 목적, 키워드와 관련도가 높은 문단만 선택
+    pdf_contents = build_pdf_contents(
+        st.session_state.get('pdf_handles', []),
+        f"{user_input} {keywords} {research_purpose}",
+        PDF_CONTENT_TOKEN_BUDGET
+    )
+    korean_authors = False
+    for i, content in enumerate(pdf_contents):
+        metadata = st.session_state.get('pdf_metadata', [])
+        if i < len(metadata):
+            current_metadata = metadata[i]
+            if isinstance(current_metadata, dict):
+                is_korean = current_metadata.get('is_korean', False)
+            else:
+                is_korean = False
+        else:
+            is_korean = False
+
+        content["is_korean"] = is_korean
+        if is_korean:
+            korean_authors = True
+    
+    pdf_content_json = json.dumps(pdf_contents, ensure_ascii=False)
+    
+    prompt = PREDEFINED_PROMPTS["2. 연구 배경"].format(
+        user_input=user_input,
+        keywords=keywords,
+        research_purpose=research_purpose,
+        pdf_content=pdf_content_json,
+        korean_authors=korean_authors
+    )
+    
+    # 추출된 참고문헌 정보 추가
+    prompt += "\n\n다음은 제공된 PDF 파일들의 정확한 참고문헌 정보입니다. 연구 배경 작성 시 반드시 이 정보만을 사용하여 인용해주세요:\n"
+    for metadata in st.session_state.pdf_metadata:
+        if metadata:  # metadata가 비어있지 않은 경우에만 처리
+            author = metadata[0][0] if metadata[0] else "Unknown"
+            year = metadata[0][1] if len(metadata[0]) > 1 else "Unknown"
+            prompt += f"[{author}, {year}]\n"
+
+    if 'pdf_token_report' in st.session_state:
+        st.session_state.pdf_token_report["prompt_tokens"] = count_prompt_tokens(prompt)
+    return prompt
+
 # 2. 연구 배경 작성 함수
 def write_research_background():
     st.markdown("## 2. 연구 배경")
@@ -658,17 +2216,27 @@ def write_research_background():
             
         if st.button("논문 검색"):
             if keywords_list:
-                search_query = " ".join(keywords_list)
-                
-                with st.spinner("논문을 검색 중입니다..."):
-                    scholar_results = search_google_scholar(search_query)
-                    
-                st.session_state.scholar_results = scholar_results
-                st.success("검색이 완료되었습니다.")
-                st.rerun()
-                
+                # 이전 검색이 아직 진행 중이면 중단하고 새로 검색
+                if st.session_state.get('scholar_search'):
+                    cancel_scholar_search(st.session_state.scholar_search)
+                st.session_state.scholar_search = start_scholar_search(keywords_list)
+                st.session_state.scholar_results = []
+                st.session_state.pop('scholar_search_status', None)
+
+        # 검색 중에는 결과가 도착하는 대로 표시
+        if st.session_state.get('scholar_search'):
+            render_scholar_search_progress()
+        elif st.session_state.get('scholar_search_status') in ("done", "cached"):
+            st.success(SCHOLAR_SEARCH_MESSAGES[st.session_state.scholar_search_status])
+        elif st.session_state.get('scholar_search_status') == "error":
+            st.error(SCHOLAR_SEARCH_MESSAGES["error"])
+            for query, error in st.session_state.get('scholar_search_errors', []):
+                st.caption(f"'{query}': {error}")
+        elif st.session_state.get('scholar_search_status'):
+            st.warning(SCHOLAR_SEARCH_MESSAGES[st.session_state.scholar_search_status])
+
         # 검색 결과 표시
-        if 'scholar_results' in st.session_state:
+        if 'scholar_results' in st.session_state and not st.session_state.get('scholar_search'):
             st.subheader("Google Scholar 검색 결과 (최대 15개)")
             for i, result in enumerate(st.session_state.scholar_results):
                 col1, col2 = st.columns([3, 1])
@@ -692,63 +2260,42 @@ def write_research_background():
     uploaded_files = st.file_uploader("연구 배경 작성에 참고할 선행연구 논문 PDF 파일을 업로드하세요. 중요한 논문 위주로 4개 이하 업로드를 추천합니다. \n**주의:** 검색 결과의 논문 내용은 자동으로 반영되지 않습니다. \n검색된 논문들을 사용하시려면 각 웹페이지에서 PDF 파일을 다운 받은 후 여기에 업로드 하세요.", type="pdf", accept_multiple_files=True)
     
     if uploaded_files:
-        st.session_state.pdf_texts = []
-        st.session_state.pdf_files = uploaded_files
-        st.session_state.pdf_metadata = []
-        for uploaded_file in uploaded_files:
-            pdf_text = extract_text_from_pdf(uploaded_file)
-            st.session_state.pdf_texts.append(pdf_text)
-            metadata = extract_references(pdf_text)
-            st.session_state.pdf_metadata.append(metadata)
+        # 원본은 디스크 저장소에 두고 세션 상태에는 해시와 파일 이름만 보관
+        # 업로드된 파일 구성이 바뀐 경우에만 텍스트와 참고문헌 정보를 다시 만듦
+        pdf_handles = [store_pdf_blob(uploaded_file) for uploaded_file in uploaded_files]
+        if st.session_state.get('pdf_handles') != pdf_handles:
+            retain_pdf_blobs([handle["hash"] for handle in pdf_handles])
+            progress = st.progress(0.0, text="PDF 텍스트 추출 중...")
+
+            def on_progress(done, total, name):
+                progress.progress(done / total, text=f"PDF 텍스트 추출 중... ({done}/{total}) {name}")
+
+            ingest_pdfs(pdf_handles, on_progress)
+            st.session_state.pdf_handles = pdf_handles
+            st.session_state.pdf_metadata = [extract_references(pdf_text) for pdf_text in get_session_pdf_texts()]
+            progress.empty()
         st.success(f"{len(uploaded_files)}개의 PDF 파일이 성공적으로 업로드되었습니다.")
+        failed_files = [handle["name"] for handle in st.session_state.pdf_handles if load_pdf_document_by_hash(handle["hash"]).get("error")]
+        if failed_files:
+            st.warning(f"다음 PDF 파일에서 텍스트를 추출하지 못했습니다 (암호화되었거나 손상된 파일일 수 있습니다): {', '.join(failed_files)}")
+        original_tokens, compacted_tokens = pdf_compaction_totals(st.session_state.pdf_handles)
+        if original_tokens > compacted_tokens:
+            st.caption(f"🧹 반복되는 머리글/바닥글, 줄바꿈 하이픈, 공백을 정리하여 약 {original_tokens - compacted_tokens} 토큰을 줄였습니다. ({original_tokens} → {compacted_tokens} 토큰)")
+
+    # 마지막 연구 배경 요청에서 PDF별로 전송된 토큰 수 표시
+    if st.session_state.get('pdf_token_report'):
+        report = st.session_state.pdf_token_report
+        with st.expander("📏 PDF 내용 토큰 사용량 (마지막 요청 기준)"):
+            for item in report["files"]:
+                st.caption(f"{item['file_name']}: {item['original_tokens']} → {item['sent_tokens']} 토큰")
+            if report.get("prompt_tokens"):
+                st.caption(f"전체 프롬프트: 약 {report['prompt_tokens']} 토큰")
 
 
     # 연구 배경 생성 버튼
     if st.button("연구배경 AI 생성 요청✍🏻"):
-        if 'pdf_texts' in st.session_state and st.session_state['pdf_texts']:
-            research_purpose = load_section_content("1. 연구 목적")
-            
-            pdf_contents = []
-            korean_authors = False
-            for i, pdf_text in enumerate(st.session_state['pdf_texts']):
-                extracted_sections = extract_sections(pdf_text)
-                metadata = st.session_state.get('pdf_metadata', [])
-                if i < len(metadata):
-                    current_metadata = metadata[i]
-                    if isinstance(current_metadata, dict):
-                        is_korean = current_metadata.get('is_korean', False)
-                    else:
-                        is_korean = False
-                else:
-                    is_korean = False
-
-                pdf_contents.append({
-                    "file_name": st.session_state['pdf_files'][i].name,
-                    "abstract": extracted_sections['abstract'],
-                    "introduction": extracted_sections['introduction'],
-                    "conclusion": extracted_sections['conclusion'],
-                    "is_korean": is_korean
-                })
-                if is_korean:
-                    korean_authors = True
-            
-            pdf_content_json = json.dumps(pdf_contents)
-            
-            prompt = PREDEFINED_PROMPTS["2. 연구 배경"].format(
-                user_input=user_input,
-                keywords=keywords,
-                research_purpose=research_purpose,
-                pdf_content=pdf_content_json,
-                korean_authors=korean_authors
-            )
-            
-            # 추출된 참고문헌 정보 추가
-            prompt += "\n\n다음은 제공된 PDF 파일들의 정확한 참고문헌 정보입니다. 연구 배경 작성 시 반드시 이 정보만을 사용하여 인용해주세요:\n"
-            for metadata in st.session_state.pdf_metadata:
-                if metadata:  # metadata가 비어있지 않은 경우에만 처리
-                    author = metadata[0][0] if metadata[0] else "Unknown"
-                    year = metadata[0][1] if len(metadata[0]) > 1 else "Unknown"
-                    prompt += f"[{author}, {year}]\n"
+        if st.session_state.get('pdf_handles'):
+            prompt = build_research_background_prompt(user_input, keywords)
             
             ai_response = generate_ai_response(prompt)
 
@@ -822,7 +2369,7 @@ def write_research_background():
                     
                     수정된 전체 연구 배경을 1000자 이내로 작성해주세요.
                     """
-                    modified_response = generate_ai_response(prompt)
+                    modified_response = revise_section_content("2. 연구 배경", current_content, prompt)
                     
                     save_section_content("2. 연구 배경", modified_response)
                     st.session_state.show_modification_request_2 = False
@@ -922,16 +2469,9 @@ def write_selection_criteria():
     )
    
     if st.button("선정, 제외기준 AI에게 추천받기✍🏻"):
-        research_purpose = load_section_content("1. 연구 목적")
-        research_background = load_section_content("2. 연구 배경")
-        
-        prompt = PREDEFINED_PROMPTS["3. 선정기준, 제외기준"].format(
-            user_input=user_input,
-            research_purpose=research_purpose,
-            research_background=research_background
-        )
+        prompt, context_sections = build_section_prompt("3. 선정기준, 제외기준", user_input)
         
-        ai_response = generate_ai_response(prompt)
+        ai_response = generate_ai_response(prompt, context_sections=context_sections)
         
         # 현재 내용을 히스토리에 추가
         current_content = load_section_content("3. 선정기준, 제외기준")
@@ -983,7 +2523,7 @@ def write_selection_criteria():
                     
                     수정된 전체 선정기준, 제외기준을 작성해주세요.
                     """
-                    modified_response = generate_ai_response(prompt)
+                    modified_response = revise_section_content("3. 선정기준, 제외기준", current_content, prompt)
                     
                     save_section_content("3. 선정기준, 제외기준", modified_response)
                     st.session_state.show_modification_request_3 = False
@@ -1049,20 +2589,14 @@ def write_sample_size():
         st.write("대상자 수가 입력되지 않았습니다. AI에게 추천을 받으세요.")
 
     if st.button("대상자 수 및 산출근거 AI에게 추천받기✍🏻"):
-        research_purpose = load_section_content("1. 연구 목적")
-        research_background = load_section_content("2. 연구 배경")
-        selection_criteria = load_section_content("3. 선정기준, 제외기준")
-        
-        prompt = PREDEFINED_PROMPTS["4. 대상자 수 및 산출근거"].format(
-            research_purpose=research_purpose,
-            research_background=research_background,
-            selection_criteria=selection_criteria,
+        prompt, context_sections = build_section_prompt(
+            "4. 대상자 수 및 산출근거",
             total_subjects=total_subjects if internal_subjects is not None and external_subjects is not None else "미입력",
             internal_subjects=internal_subjects if internal_subjects is not None else "미입력",
             external_subjects=external_subjects if external_subjects is not None else "미입력"
         )
         
-        ai_response = generate_ai_response(prompt)
+        ai_response = generate_ai_response(prompt, context_sections=context_sections)
         
        # 현재 내용을 히스토리에 추가
         current_content = load_section_content("4. 대상자 수 및 산출근거")
@@ -1114,7 +2648,7 @@ def write_sample_size():
                     
                     수정된 전체 대상자 수 및 산출근거를 작성해주세요.
                     """
-                    modified_response = generate_ai_response(prompt)
+                    modified_response = revise_section_content("4. 대상자 수 및 산출근거", current_content, prompt)
                     
                     save_section_content("4. 대상자 수 및 산출근거", modified_response)
                     st.session_state.show_modification_request_4 = False
@@ -1173,20 +2707,9 @@ def write_data_analysis():
     )
   
     if st.button("자료분석 및 통계방법 AI에게 추천받기✍🏻"):
-        research_purpose = load_section_content("1. 연구 목적")
-        research_background = load_section_content("2. 연구 배경")
-        selection_criteria = load_section_content("3. 선정기준, 제외기준")
-        sample_size = load_section_content("4. 대상자 수 및 산출근거")
-        
-        prompt = PREDEFINED_PROMPTS["5. 자료분석과 통계적 방법"].format(
-            user_input=user_input,
-            research_purpose=research_purpose,
-            research_background=research_background,
-            selection_criteria=selection_criteria,
-            sample_size=sample_size
-        )
+        prompt, context_sections = build_section_prompt("5. 자료분석과 통계적 방법", user_input)
         
-        ai_response = generate_ai_response(prompt)
+        ai_response = generate_ai_response(prompt, context_sections=context_sections)
         
         # 현재 내용을 히스토리에 추가
         current_content = load_section_content("5. 자료분석과 통계적 방법")
@@ -1242,7 +2765,7 @@ def write_data_analysis():
 
                     수정된 전체 자료분석과 통계적 방법을 작성해주세요. 모든 문장이 미래형으로 작성되었는지 다시 한 번 확인하세요.
                     """
-                    modified_response = generate_ai_response(prompt)
+                    modified_response = revise_section_content("5. 자료분석과 통계적 방법", current_content, prompt)
                     
                     save_section_content("6. 자료분석과 통계적 방법", modified_response)
                     st.session_state.show_modification_request_5 = False
@@ -1301,21 +2824,9 @@ def write_research_method():
         st.session_state["6. 연구방법_history"] = []
 
     if st.button("연구방법 정리 요청하기✍🏻"):
-        research_purpose = load_section_content("1. 연구 목적")
-        research_background = load_section_content("2. 연구 배경")
-        selection_criteria = load_section_content("3. 선정기준, 제외기준")
-        sample_size = load_section_content("4. 대상자 수 및 산출근거")
-        data_analysis = load_section_content("5. 자료분석과 통계적 방법")
+        prompt, context_sections = build_section_prompt("6. 연구방법")
         
-        prompt = PREDEFINED_PROMPTS["6. 연구방법"].format(
-            research_purpose=research_purpose,
-            research_background=research_background,
-            selection_criteria=selection_criteria,
-            sample_size=sample_size,
-            data_analysis=data_analysis
-        )
-        
-        ai_response = generate_ai_response(prompt)
+        ai_response = generate_ai_response(prompt, context_sections=context_sections)
         
         # 현재 내용을 히스토리에 추가
         current_content = load_section_content("6. 연구방법")
@@ -1373,7 +2884,7 @@ def write_research_method():
                     
                     수정된 전체 연구방법을 작성해주세요. 모든 문장이 미래형으로 작성되었는지 다시 한 번 확인하세요.
                     """
-                    modified_response = generate_ai_response(prompt)
+                    modified_response = revise_section_content("6. 연구방법", current_content, prompt)
                     
                     save_section_content("6. 연구방법", modified_response)
                     st.session_state.show_modification_request_6 = False
@@ -1455,27 +2966,11 @@ def write_research_title():
 
     # "연구 과제명 추천받기" 버튼을 여기로 이동
     if st.button("연구 과제명 AI에게 추천받기✍🏻"):
-        research_purpose = load_section_content("1. 연구 목적")
-        research_background = load_section_content("2. 연구 배경")
-        selection_criteria = load_section_content("3. 선정기준, 제외기준")
-        sample_size = load_section_content("4. 대상자 수 및 산출근거")
-        data_analysis = load_section_content("5. 자료분석과 통계적 방법")
-        research_method = load_section_content("6. 연구방법")
-        
-        prompt = PREDEFINED_PROMPTS["7. 연구 과제명"].format(
-            user_input=user_input,
-            research_purpose=research_purpose,
-            research_background=research_background,
-            selection_criteria=selection_criteria,
-            sample_size=sample_size,
-            data_analysis=data_analysis,
-            research_method=research_method
-        )
+        prompt, context_sections = build_section_prompt("7. 연구 과제명", user_input)
         
-        ai_response = generate_ai_response(prompt)
-        
-        # AI 응답 파싱 및 검증
-        options = parse_and_validate_titles(ai_response)
+        # 구조화된 출력으로 영문/한글 제목 쌍을 받아옴
+        with st.spinner("연구 과제명을 생성 중입니다..."):
+            options = generate_title_options(prompt, context_sections)
         
         if options:
             save_section_content("7. 연구 과제명", "\n\n".join(options))
@@ -1582,11 +3077,14 @@ def write_research_title():
                 [영문 제목]
                 [한글 제목]
                 """
-                modified_response = generate_ai_response(prompt)
+                options = generate_title_options(prompt)
                 
-                save_section_content("7. 연구 과제명", modified_response)
-                st.session_state.show_modification_request_7 = False
-                st.rerun()
+                if options:
+                    save_section_content("7. 연구 과제명", "\n\n".join(options))
+                    st.session_state.show_modification_request_7 = False
+                    st.rerun()
+                else:
+                    st.error("AI가 올바른 형식의 연구 과제명을 생성하지 못했습니다. 다시 시도해주세요.")
             else:
                 st.warning("수정 요청 내용을 입력해주세요.")
     
@@ -1623,83 +3121,102 @@ def display_references():
     st.markdown("### 참고문헌")
     references = format_references(
         st.session_state.get('scholar_results', []),
-        st.session_state.get('pdf_files', [])
+        st.session_state.get('pdf_handles', [])
     )
     for i, ref in enumerate(references, 1):
         st.markdown(f"{i}. {ref}")
 
 
-def extract_pdf_metadata(pdf_file):
+# 메타데이터를 찾지 못했을 때의 기본값
+UNKNOWN_PDF_METADATA = {
+    'title': "Unknown title",
+    'authors': "Unknown authors",
+    'affiliations': "Unknown affiliations",
+    'year': "Unknown year",
+    'is_korean': False,
+    'doi': ""
+}
+
+# 로컬에서 추출한 서지 정보를 그대로 사용할 최소 신뢰도 (이보다 낮은 항목만 LLM으로 보완)
+METADATA_CONFIDENCE_THRESHOLD = float(os.environ.get("IRB_METADATA_CONFIDENCE_THRESHOLD", "0.7"))
+# 참고문헌 작성에 꼭 필요한 항목 (이 항목의 신뢰도가 낮을 때만 LLM 호출)
+METADATA_REQUIRED_FIELDS = ['title', 'authors', 'year']
+
+# PDF 서지 정보 추출: PDF Info/XMP, DOI, 첫 페이지 글자 크기, 한국 소속 판별 등 로컬 정보를 먼저 사용하고
+# 필수 항목 중 신뢰도가 낮은 항목이 있을 때만 LLM으로 신뢰도 낮은 항목을 보완
+def extract_pdf_metadata(pdf_handle):
     try:
-        text = extract_text_from_pdf(pdf_file)
-        
-        # 텍스트의 처음 부분만 사용 (API 토큰 제한을 고려)
-        text_sample = text[:5000]
-        
-        prompt = f"""
-        다음은 학술 논문의 일부입니다. 이 논문의 제목, 저자들(최대 3명까지), 저자들의 소속 기관(특히 한국 소속 여부), 출판 연도를 추출해주세요.
-        결과는 다음 형식으로 작성해주세요:
-        제목: [논문 제목]
-        저자: [저자1], [저자2], [저자3]
-        소속: [소속1], [소속2], [소속3] (한국 소속이 있다면 'Korean' 태그를 추가, Seoul도 한국으로 간주)
-        연도: [출판 연도]
-        
-        정보를 찾을 수 없는 경우 다음과 같이 구체적으로 표시해주세요:
-        - 제목을 찾을 수 없는 경우: "Unknown title"
-        - 저자를 찾을 수 없는 경우: "Unknown authors"
-        - 소속을 찾을 수 없는 경우: "Unknown affiliations"
-        - 연도를 찾을 수 없는 경우: "Unknown year"
-        
-        논문 내용:
-        {text_sample}
-        """
-        
-        response = st.session_state.anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=300,
-            messages=[{"role": "user", "content": prompt}]
-        )
-        
-        result = response.content[0].text
-        
-       # 결과 파싱
-        title = re.search(r'제목: (.+)', result)
-        authors = re.search(r'저자: (.+)', result)
-        affiliations = re.search(r'소속: (.+)', result)
-        year = re.search(r'연도: (.+)', result)
-        is_korean = re.search(r'한국 소속 여부: (.+)', result)
-        
+        document = load_pdf_document_by_hash(pdf_handle["hash"])
+        local_metadata = document.get("metadata", {})
+        fields = PDF_METADATA_TOOL["input_schema"]["required"]
+        values = {field: local_metadata[field]["value"] for field in fields if field in local_metadata}
+        low_confidence = [
+            field for field in fields
+            if field not in local_metadata or local_metadata[field]["confidence"] < METADATA_CONFIDENCE_THRESHOLD
+        ]
+
+        if any(field in low_confidence for field in METADATA_REQUIRED_FIELDS):
+            try:
+                # 텍스트의 처음 부분만 토큰 예산 안에서 사용 (제목, 저자, 소속은 대개 첫 페이지에 있음)
+                text_sample = truncate_to_token_budget(document["text"], METADATA_SAMPLE_TOKEN_BUDGET)
+
+                prompt = f"""
+                다음은 학술 논문의 일부입니다. 이 논문의 제목, 저자들(최대 3명까지), 저자들의 소속 기관(특히 한국 소속 여부), 출판 연도를 추출하여 {PDF_METADATA_TOOL['name']} 도구로 제출해주세요.
+                특히 다음 항목을 정확히 확인해주세요: {", ".join(low_confidence)}
+                저자 중 한국 소속 기관(Seoul 등 한국 지역 포함)이 있다면 is_korean을 true로 표시해주세요.
+                찾을 수 없는 항목은 빈 문자열 또는 빈 목록으로 제출해주세요.
+
+                논문 내용:
+                {text_sample}
+                """
+
+                result = request_structured_output(
+                    route="metadata",
+                    system=None,
+                    messages=[{"role": "user", "content": prompt}],
+                    tool=PDF_METADATA_TOOL,
+                    label="extract_pdf_metadata"
+                )
+                for field in low_confidence:
+                    if result[field] or field not in values:
+                        values[field] = result[field]
+            except Exception as e:
+                print(f"Error extracting metadata with LLM from {pdf_handle['name']}, using local metadata: {str(e)}")
+
+        doi = local_metadata.get("doi", {})
         return {
-            'title': title.group(1) if title else "Unknown title",
-            'authors': authors.group(1) if authors else "Unknown authors",
-            'affiliations': affiliations.group(1) if affiliations else "Unknown affiliations",
-            'year': year.group(1) if year else "Unknown year",
-            'is_korean': is_korean.group(1).lower() == '예' if is_korean else False
+            'title': values.get('title') or "Unknown title",
+            'authors': ", ".join(values.get('authors', [])[:3]) or "Unknown authors",
+            'affiliations': ", ".join(values.get('affiliations', [])) or "Unknown affiliations",
+            'year': values.get('year') or "Unknown year",
+            'is_korean': bool(values.get('is_korean', False)),
+            'doi': doi.get("value", "") if doi.get("confidence", 0) >= METADATA_CONFIDENCE_THRESHOLD else ""
         }
     except Exception as e:
-        print(f"Error extracting metadata from {pdf_file.name}: {str(e)}")
-        return {
-            'title': "Unknown title",
-            'authors': "Unknown authors",
-            'affiliations': "Unknown affiliations",
-            'year': "Unknown year",
-            'is_korean': False
-        }
+        print(f"Error extracting metadata from {pdf_handle['name']}: {str(e)}")
+        return dict(UNKNOWN_PDF_METADATA)
+
+# 섹션별 검토 설정
+REVIEW_MAX_WORKERS = 7
+REVIEW_SHARD_INSTRUCTION = """
+    이번 검토에서는 '{section}' 섹션의 문장에 대해서만 피드백을 작성해 주세요.
+    다른 섹션의 내용은 맥락을 파악하는 용도로만 참고하고, 다른 섹션의 문장은 인용하지 마세요.
+    section 항목에는 반드시 '{section}'을 적어 주세요.
+    수정이 필요한 부분이 없다면 빈 목록을 제출해 주세요.
+    """
 
 # 전체 연구계획서 점검 및 피드백 함수
-def review_full_research_plan():
+# on_shard_done(section, feedback)이 주어지면 섹션별 검토가 끝나는 대로 호출
+def review_full_research_plan(on_shard_done=None):
     # 각 섹션의 내용을 불러오기
     sections = ["1. 연구 목적", "2. 연구 배경", "3. 선정기준, 제외기준", "4. 대상자 수 및 산출근거", 
                 "5. 자료분석과 통계적 방법", "6. 연구방법", "7. 연구 과제명"]
-    full_content = ""
-    for section in sections:
-        content = load_section_content(section)
-        if content:
-            full_content += f"{section}:\n{content}\n\n"
+    # 내용이 있는 섹션만 프롬프트 캐시 접두부로 앞에 붙여 전송
+    context_sections = [section for section in sections if load_section_content(section)]
 
 # 전체 내용을 검토하고 피드백을 제공하도록 AI에게 요청
     prompt = f"""
-    다음은 작성된 연구계획서의 전체 내용입니다.
+    앞서 제공된 내용은 작성된 연구계획서의 전체 내용입니다.
     제가 작성한 연구계획서를 검토하고, 다음의 네 가지 지침을 바탕으로 수정이 필요한 부분만 지적해 주세요:
     1. 반드시 기존 문장을 인용하여, 어떤 문장이 수정이 필요한지 명확히 표시해 주세요.
     2. 왜 수정을 제안했는지 이유를 구체적으로 설명해 주세요.
@@ -1707,20 +3224,15 @@ def review_full_research_plan():
     4. 두루뭉술한 표현은 피하고, 모든 피드백은 구체적이고 명확한 문장으로 작성해 주세요.
 
     **출력 형식 (반드시 준수):**
-    - 피드백에는 수정 제안이 발생한 섹션 이름을 반드시 포함해야 합니다.
-    - 필요에 따라 섹션 이름을 여러 번 사용해도 무방합니다.
-    - 각 수정 제안은 다음과 같은 구조로 작성해주세요:
-
-    <섹션 이름>: {{섹션 제목}}
-    수정 이유: {{수정 이유를 구체적으로 설명}}
-    기존 문장: ```{{기존 문장}}```
-    수정 예시: ```{{수정 예시}}```
+    - 검토 결과는 {REVIEW_FEEDBACK_TOOL['name']} 도구로 제출해 주세요.
+    - 각 수정 제안에는 섹션 이름(section), 수정 이유(reason), 기존 문장(original), 수정 예시(suggestion)를 모두 채워 주세요.
+    - 필요에 따라 같은 섹션에 대해 여러 개의 수정 제안을 제출해도 무방합니다.
 
     예시:
-    <섹션 이름>: 1. 연구 목적
-    수정 이유: 연구 목적의 명확성이 부족합니다.
-    기존 문장: ```본 연구는 신장 조직 검사를 통해 ...```
-    수정 예시: ```본 연구는 신장 조직 검사를 활용하여 정확한 진단 기준을 수립하는 것을 목표로 합니다.```
+    section: 1. 연구 목적
+    reason: 연구 목적의 명확성이 부족합니다.
+    original: 본 연구는 신장 조직 검사를 통해 ...
+    suggestion: 본 연구는 신장 조직 검사를 활용하여 정확한 진단 기준을 수립하는 것을 목표로 합니다.
 
     **피드백 작성 지침:**
 
@@ -1754,57 +3266,84 @@ def review_full_research_plan():
     - 수정 이유는 간단 명료하게 작성하고, 수정 제안은 구체적으로 작성해 주세요.
     - 프롬프트에 제시된 기준 이외의 항목은 고려하지 마세요.
     - 출력 형식을 항상 준수 해 주세요.
-
-    전체 내용:
-    {full_content}
     """
     
     try:
         if 'anthropic_client' in st.session_state and st.session_state.anthropic_client:
-            # AI 피드백 요청
-            response = st.session_state.anthropic_client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=4000,
-                messages=[{"role": "user", "content": prompt}]
+            # AI 피드백 요청: 섹션별로 나누어 검토한 뒤 섹션 순서대로 병합
+            # (연구계획서 전체 내용과 검토 지침은 모든 요청이 공유하는 프롬프트 캐시 접두부)
+            # 프롬프트 캐시는 첫 응답이 시작된 뒤에야 다른 요청에서 읽을 수 있으므로,
+            # 첫 섹션을 먼저 검토하여 접두부를 한 번만 캐시에 쓰고 나머지 섹션은 그 뒤에 동시에 검토
+            _, shared_blocks = apply_prompt_cache_breakpoints(
+                None,
+                build_section_context_blocks(context_sections) + [{"type": "text", "text": prompt}]
             )
-            feedback = response.content[0].text
-            return feedback  # 피드백 반환
+
+            def review_section(section):
+                messages = [{
+                    "role": "user",
+                    "content": shared_blocks + [{"type": "text", "text": REVIEW_SHARD_INSTRUCTION.format(section=section)}]
+                }]
+
+                result = request_structured_output(
+                    route="review",
+                    system=None,
+                    messages=messages,
+                    tool=REVIEW_FEEDBACK_TOOL,
+                    label=f"review_full_research_plan ({section})"
+                )
+                # 섹션 이름은 검토 대상 섹션으로 통일
+                return [dict(item, section=section) for item in result['suggestions']]
+
+            shard_feedback = {}
+
+            def collect(section, future):
+                try:
+                    shard_feedback[section] = future.result()
+                except Exception as e:
+                    st.error(f"'{section}' 검토 중 오류 발생: {str(e)}")
+                    return
+                # 먼저 끝난 섹션의 피드백부터 바로 전달
+                if on_shard_done and shard_feedback[section]:
+                    on_shard_done(section, shard_feedback[section])
+
+            ctx = get_script_run_ctx()
+            with ThreadPoolExecutor(max_workers=REVIEW_MAX_WORKERS) as executor:
+                if context_sections:
+                    first_section = context_sections[0]
+                    collect(first_section, executor.submit(run_with_script_run_ctx, ctx, review_section, first_section))
+                futures = {
+                    executor.submit(run_with_script_run_ctx, ctx, review_section, section): section
+                    for section in context_sections[1:]
+                }
+                for future in as_completed(futures):
+                    collect(futures[future], future)
+
+            feedback = [item for section in context_sections for item in shard_feedback.get(section, [])]
+            return feedback  # 피드백 반환 (수정 제안 목록)
         else:
             st.error("API 클라이언트가 초기화되지 않았습니다. API 키를 다시 확인해주세요.")
-            return "API 초기화 오류로 인해 피드백을 생성할 수 없습니다."
+            return []
     except anthropic.APIError as e:
         st.error(f"Anthropic API 오류: {str(e)}")
-        return f"API 오류: {str(e)}"
+        return []
     except Exception as e:
         st.error(f"예상치 못한 오류 발생: {str(e)}")
-        return f"오류 발생: {str(e)}"
+        return []
 
 
-def format_references(pdf_files):
+# PDF별 텍스트 추출과 메타데이터 요청을 동시에 실행 (결과는 업로드 순서 유지)
+def format_references(pdf_handles):
     references = []
-    for i, pdf_file in enumerate(pdf_files, start=1):
-        metadata = extract_pdf_metadata(pdf_file)
+    all_metadata = parallel_map(extract_pdf_metadata, pdf_handles, max_workers=PDF_METADATA_MAX_WORKERS,
+                                default=UNKNOWN_PDF_METADATA)
+    for i, metadata in enumerate(all_metadata, start=1):
         reference = f"{i}. {metadata['authors']}. {metadata['title']}. {metadata['year']}."
+        if metadata.get('doi'):
+            reference += f" doi:{metadata['doi']}"
         references.append(reference)
     return references
 
-def parse_and_validate_titles(response):
-    lines = response.split('\n')
-    options = []
-    current_option = []
-    
-    for line in lines:
-        if line.strip().startswith(('1.', '2.', '3.')):
-            if current_option:
-                options.append('\n'.join(current_option))
-                current_option = []
-        current_option.append(line.strip())
-    
-    if current_option:
-        options.append('\n'.join(current_option))
-    
-    return [opt for opt in options if is_valid_title_option(opt)]
-
 def is_valid_title_option(option):
     lines = option.split('\n')
     return len(lines) >= 2 and lines[0].strip() and lines[1].strip()
@@ -1822,6 +3361,423 @@ def extract_references(text):
     # 각 참고문헌을 [저자, 연도] 형식의 리스트로 변환
     return [ref.split(',') for ref in set(references)]
 
+# 전체 연구계획서 일괄 생성 시 작업 간 의존 관계
+# 섹션은 1 → 2 → ... → 7 순서로 이어지고, 참고문헌 정리는 독립적으로, 전체 점검은 모든 섹션 이후에 실행
+PROTOCOL_PIPELINE_DEPENDENCIES = {
+    "1. 연구 목적": [],
+    "2. 연구 배경": ["1. 연구 목적"],
+    "3. 선정기준, 제외기준": ["2. 연구 배경"],
+    "4. 대상자 수 및 산출근거": ["3. 선정기준, 제외기준"],
+    "5. 자료분석과 통계적 방법": ["4. 대상자 수 및 산출근거"],
+    "6. 연구방법": ["5. 자료분석과 통계적 방법"],
+    "7. 연구 과제명": ["6. 연구방법"],
+    "참고문헌": [],
+    "전체 점검": list(RESEARCH_SECTIONS),
+}
+PROTOCOL_PIPELINE_MAX_WORKERS = 4
+
+PIPELINE_STATUS_LABELS = {
+    "pending": "⏳ 대기 중",
+    "running": "🔄 생성 중",
+    "done": "✅ 완료",
+    "failed": "⚠️ 실패",
+    "skipped": "⏭️ 건너뜀 (이전 단계 실패)",
+}
+
+# 의존 관계 그래프에 따라 실행 가능한 작업을 동시에 실행
+# 작업이 실패하면 그 작업에 의존하는 작업은 건너뜀. on_status(node, state, error)로 진행 상황 전달
+def run_dependency_graph(tasks, dependencies, on_status=None, max_workers=4):
+    status = {node: "pending" for node in tasks}
+    errors = {}
+    ctx = get_script_run_ctx()
+
+    def set_status(node, state):
+        status[node] = state
+        if on_status:
+            on_status(node, state, errors.get(node))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while True:
+            changed = True
+            while changed:
+                changed = False
+                for node, task in tasks.items():
+                    if status[node] != "pending":
+                        continue
+                    deps = [dep for dep in dependencies.get(node, []) if dep in tasks]
+                    if any(status[dep] in ("failed", "skipped") for dep in deps):
+                        set_status(node, "skipped")
+                        changed = True
+                    elif all(status[dep] == "done" for dep in deps):
+                        running[executor.submit(run_with_script_run_ctx, ctx, task)] = node
+                        set_status(node, "running")
+                        changed = True
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    future.result()
+                    set_status(node, "done")
+                except Exception as e:
+                    print(f"Error in pipeline task {node}: {str(e)}")
+                    errors[node] = str(e)
+                    set_status(node, "failed")
+    return status, errors
+
+# 생성된 섹션을 저장하면서 기존 내용은 히스토리에 보관
+def save_generated_section(section, content):
+    current_content = load_section_content(section)
+    if current_content:
+        st.session_state.setdefault(f"{section}_history", []).append(current_content)
+    save_section_content(section, content)
+
+# 섹션 하나를 생성하는 작업 함수
+def make_section_task(section, user_input, overwrite):
+    def task():
+        if not overwrite and load_section_content(section):
+            return
+        if section == "1. 연구 목적" and not user_input:
+            raise ValueError("연구 주제나 키워드를 입력해주세요.")
+        if section == "2. 연구 배경" and not st.session_state.get('pdf_handles'):
+            raise ValueError("'2. 연구 배경' 섹션에서 참고논문 PDF를 먼저 업로드해주세요.")
+
+        prompt, context_sections = build_section_prompt(section, user_input if section == "1. 연구 목적" else "")
+        save_generated_section(section, generate_section_draft(section, prompt, context_sections))
+    return task
+
+# 화면 출력 없이 섹션 초안을 생성 (일괄 생성, 미리 생성 작업에서 사용)
+def generate_section_draft(section, prompt, context_sections):
+    if section == "7. 연구 과제명":
+        options = generate_title_options(prompt, context_sections, raise_errors=True)
+        return "\n\n".join(options)
+    return generate_ai_response(prompt, stream=False, context_sections=context_sections, raise_errors=True, route=section_route(section), label=section)
+
+def references_task():
+    pdf_handles = st.session_state.get('pdf_handles', [])
+    if pdf_handles:
+        save_section_content("참고문헌", "\n".join(format_references(pdf_handles)))
+
+def review_task():
+    feedback = review_full_research_plan()
+    st.session_state.review_feedback = feedback
+    st.session_state.review_clicked = True
+
+# 전체 연구계획서 초안을 한 번에 생성하고 단계별 진행 상황을 표시
+def run_protocol_pipeline(user_input, overwrite=False):
+    tasks = {section: make_section_task(section, user_input, overwrite) for section in RESEARCH_SECTIONS}
+    tasks["참고문헌"] = references_task
+    tasks["전체 점검"] = review_task
+
+    placeholders = {node: st.empty() for node in tasks}
+    for node, placeholder in placeholders.items():
+        placeholder.markdown(f"**{node}** — {PIPELINE_STATUS_LABELS['pending']}")
+
+    def on_status(node, state, error):
+        message = f"**{node}** — {PIPELINE_STATUS_LABELS[state]}"
+        if error:
+            message += f": {error}"
+        placeholders[node].markdown(message)
+
+    status, errors = run_dependency_graph(
+        tasks,
+        PROTOCOL_PIPELINE_DEPENDENCIES,
+        on_status=on_status,
+        max_workers=PROTOCOL_PIPELINE_MAX_WORKERS
+    )
+    return status, errors
+
+# 여러 연구계획서 일괄 생성(Message Batches) 설정
+# 섹션마다 이전 섹션 내용이 필요하므로 섹션 순서대로 한 단계(배치)씩 제출
+# '2. 연구 배경'은 연구계획서별 참고논문 PDF가 필요하므로 일괄 생성에서 제외
+BATCH_JOB_DIR = os.environ.get("IRB_BATCH_JOB_DIR", os.path.join(".cache", "batches"))
+BATCH_SECTIONS = [section for section in RESEARCH_SECTIONS if section != "2. 연구 배경"]
+BATCH_BETAS = ["prompt-caching-2024-07-31"]
+
+# 일괄 요청 하나(custom_id + 요청 파라미터) 구성
+# 프롬프트 빌더가 현재 연구계획서 ID 기준으로 이전 섹션을 읽으므로 잠시 대상 ID로 바꿔서 생성
+def build_batch_request(research_id, section, topic):
+    previous_research_id = st.session_state.get('current_research_id')
+    st.session_state.current_research_id = research_id
+    try:
+        prompt, context_sections = build_section_prompt(section, topic if section == "1. 연구 목적" else "")
+        system_blocks, messages = build_generation_request(prompt, context_sections)
+    finally:
+        st.session_state.current_research_id = previous_research_id
+
+    route = MODEL_ROUTES[section_route(section)]
+    params = {
+        "model": route["model"],
+        "max_tokens": route["max_tokens"],
+        "system": system_blocks,
+        "messages": messages,
+    }
+    if section == "7. 연구 과제명":
+        params["tools"] = [TITLE_OPTIONS_TOOL]
+        params["tool_choice"] = {"type": "tool", "name": TITLE_OPTIONS_TOOL["name"]}
+    custom_id = f"{research_id}_{RESEARCH_SECTIONS.index(section)}"
+    return {"custom_id": custom_id, "params": params}
+
+# 일괄 작업 결과(응답 content 블록 목록)를 섹션 내용 문자열로 변환
+def batch_result_text(section, content_blocks):
+    if section == "7. 연구 과제명":
+        for block in content_blocks:
+            if block.get("type") == "tool_use" and block.get("name") == TITLE_OPTIONS_TOOL["name"]:
+                jsonschema.validate(block["input"], TITLE_OPTIONS_TOOL["input_schema"])
+                return "\n\n".join(f"{option['english'].strip()}\n{option['korean'].strip()}" for option in block["input"]["options"])
+        raise ValueError("연구 과제명 도구 호출 결과가 없습니다.")
+    return "".join(block.get("text", "") for block in content_blocks if block.get("type") == "text")
+
+# Anthropic Message Batches API 백엔드
+# 다른 Claude 호출과 같이 call_with_rate_limit으로 일시적인 오류(429/529/연결 오류) 시 재시도
+def anthropic_batch_submit(batch_requests):
+    client = st.session_state.anthropic_client
+    batch = call_with_rate_limit(lambda: client.beta.messages.batches.create(requests=batch_requests, betas=BATCH_BETAS))
+    return batch.id
+
+def anthropic_batch_status(batch_id):
+    client = st.session_state.anthropic_client
+    batch = call_with_rate_limit(lambda: client.beta.messages.batches.retrieve(batch_id))
+    return "ended" if batch.processing_status == "ended" else "in_progress"
+
+def anthropic_batch_results(batch_id):
+    client = st.session_state.anthropic_client
+
+    # 결과 스트림을 읽는 도중 실패하면 처음부터 다시 읽음
+    def fetch():
+        results = {}
+        for entry in client.beta.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                results[entry.custom_id] = {"content": entry.result.message.to_dict()["content"]}
+            else:
+                results[entry.custom_id] = {"error": entry.result.type}
+        return results
+
+    return call_with_rate_limit(fetch)
+
+# 로컬 파일 기반 대체 백엔드 (테스트용)
+# 요청을 파일에 기록하고, 백그라운드 스레드가 일반 API 호출로 하나씩 처리하여 결과 파일에 기록
+def local_batch_dir(batch_id):
+    return os.path.join(BATCH_JOB_DIR, "local", batch_id)
+
+def local_batch_submit(batch_requests):
+    batch_id = f"local_{uuid.uuid4().hex}"
+    batch_dir = local_batch_dir(batch_id)
+    os.makedirs(batch_dir, exist_ok=True)
+    with open(os.path.join(batch_dir, "requests.jsonl"), "w", encoding="utf-8") as f:
+        for request in batch_requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+    client = st.session_state.anthropic_client
+    key_hash = hash_api_key(st.session_state.get('api_key') or "")
+    threading.Thread(target=process_local_batch, args=(batch_dir, batch_requests, client, key_hash), daemon=True).start()
+    return batch_id
+
+def process_local_batch(batch_dir, batch_requests, client, key_hash):
+    with open(os.path.join(batch_dir, "results.jsonl"), "w", encoding="utf-8") as f:
+        for request in batch_requests:
+            try:
+                response = call_with_rate_limit(
+                    lambda: client.beta.prompt_caching.messages.create(**request["params"]),
+                    estimate_tokens(request["params"]["messages"]),
+                    key_hash=key_hash
+                )
+                result = {"content": response.to_dict()["content"]}
+            except Exception as e:
+                result = {"error": str(e)}
+            f.write(json.dumps(dict(result, custom_id=request["custom_id"]), ensure_ascii=False) + "\n")
+            f.flush()
+    open(os.path.join(batch_dir, "ended"), "w").close()
+
+def local_batch_status(batch_id):
+    return "ended" if os.path.exists(os.path.join(local_batch_dir(batch_id), "ended")) else "in_progress"
+
+def local_batch_results(batch_id):
+    results = {}
+    with open(os.path.join(local_batch_dir(batch_id), "results.jsonl"), encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                results[result.pop("custom_id")] = result
+    return results
+
+BATCH_BACKENDS = {
+    "anthropic": {"label": "Anthropic Message Batches API", "submit": anthropic_batch_submit, "status": anthropic_batch_status, "results": anthropic_batch_results},
+    "local": {"label": "로컬 파일 (테스트용)", "submit": local_batch_submit, "status": local_batch_status, "results": local_batch_results},
+}
+
+# 일괄 작업 정보는 세션이 끝나도 이어서 확인할 수 있도록 JSON 파일로 보관
+def batch_job_path(job_id):
+    return os.path.join(BATCH_JOB_DIR, f"{job_id}.json")
+
+def save_batch_job(job):
+    os.makedirs(BATCH_JOB_DIR, exist_ok=True)
+    with open(batch_job_path(job["job_id"]), "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False, indent=2)
+
+# owner(API 키 해시)가 제출한 일괄 작업만 반환 (다른 사용자의 연구 주제와 초안은 보이지 않음)
+def load_batch_jobs(owner):
+    jobs = []
+    if os.path.isdir(BATCH_JOB_DIR):
+        for name in sorted(os.listdir(BATCH_JOB_DIR)):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(BATCH_JOB_DIR, name), encoding="utf-8") as f:
+                        job = json.load(f)
+                    if job.get("owner") == owner:
+                        jobs.append(job)
+                except (OSError, ValueError) as e:
+                    print(f"Error loading batch job {name}: {str(e)}")
+    return sorted(jobs, key=lambda job: job["created_at"], reverse=True)
+
+# 일괄 작업에서 받은 섹션 내용을 research_data에 반영
+def restore_batch_results(job):
+    for research_id, sections in job["results"].items():
+        for section, content in sections.items():
+            save_research_section(research_id, section, content)
+
+# 현재 단계 섹션의 요청을 모든 연구계획서에 대해 모아 제출
+def submit_batch_stage(job):
+    restore_batch_results(job)
+    section = BATCH_SECTIONS[job["stage"]]
+    batch_requests = [build_batch_request(project["research_id"], section, project["topic"]) for project in job["projects"]]
+    job["batch_id"] = BATCH_BACKENDS[job["backend"]]["submit"](batch_requests)
+    job["status"] = "in_progress"
+    save_batch_job(job)
+
+# 연구 주제 목록으로 일괄 작업을 만들고 첫 단계 제출
+def create_batch_job(topics, backend):
+    job = {
+        "job_id": f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}",
+        "backend": backend,
+        "owner": hash_api_key(st.session_state.get('api_key') or ""),
+        "created_at": time.time(),
+        "projects": [{"research_id": generate_research_id(), "topic": topic} for topic in topics],
+        "stage": 0,
+        "batch_id": None,
+        "status": "pending",
+        "results": {},
+        "errors": {},
+    }
+    submit_batch_stage(job)
+    return job
+
+# 제출한 배치가 끝났으면 결과를 반영하고 다음 단계 섹션 제출 (마지막 단계면 완료 처리)
+def poll_batch_job(job):
+    if job["status"] == "done":
+        restore_batch_results(job)
+        return job
+    backend = BATCH_BACKENDS[job["backend"]]
+    if backend["status"](job["batch_id"]) != "ended":
+        return job
+
+    section = BATCH_SECTIONS[job["stage"]]
+    results = backend["results"](job["batch_id"])
+    for project in job["projects"]:
+        research_id = project["research_id"]
+        custom_id = f"{research_id}_{RESEARCH_SECTIONS.index(section)}"
+        result = results.get(custom_id, {"error": "결과 없음"})
+        try:
+            if "error" in result:
+                raise ValueError(result["error"])
+            job["results"].setdefault(research_id, {})[section] = batch_result_text(section, result["content"])
+        except Exception as e:
+            job["errors"][custom_id] = str(e)
+
+    job["stage"] += 1
+    if job["stage"] < len(BATCH_SECTIONS):
+        submit_batch_stage(job)
+    else:
+        job["status"] = "done"
+        job["batch_id"] = None
+        save_batch_job(job)
+        restore_batch_results(job)
+    return job
+
+# 다음 섹션 미리 생성 설정 (사이드바에서 켠 경우에만 동작)
+SPECULATIVE_MAX_WORKERS = 4
+SPECULATIVE_WAIT_SECONDS = 120
+
+# 미리 생성 작업용 스레드 풀 (모든 세션이 공유)
+@st.cache_resource(show_spinner=False)
+def get_speculative_executor():
+    return ThreadPoolExecutor(max_workers=SPECULATIVE_MAX_WORKERS)
+
+# 섹션 초안이 의존하는 입력(이전 섹션 내용, PDF)의 지문
+def speculative_fingerprint(section):
+    upstream = RESEARCH_SECTIONS[:RESEARCH_SECTIONS.index(section)]
+    payload = {
+        "research_id": st.session_state.get('current_research_id'),
+        "sections": [load_section_content(s) for s in upstream],
+    }
+    if section == "2. 연구 배경":
+        payload["pdf_hashes"] = [handle["hash"] for handle in st.session_state.get('pdf_handles', [])]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+# 대기 중인 미리 생성 초안을 취소하고 버림 (이미 실행 중인 작업은 결과만 버려짐)
+def discard_speculative_draft(section):
+    draft = st.session_state.get('speculative_drafts', {}).pop(section, None)
+    if draft is not None:
+        draft["future"].cancel()
+
+# 저장된 섹션보다 뒤에 있는 섹션의 미리 생성 초안은 입력이 바뀌었으므로 모두 버림
+def invalidate_speculative_drafts(saved_section):
+    if saved_section not in RESEARCH_SECTIONS or not st.session_state.get('speculative_drafts'):
+        return
+    saved_index = RESEARCH_SECTIONS.index(saved_section)
+    for section in list(st.session_state.speculative_drafts):
+        if RESEARCH_SECTIONS.index(section) > saved_index:
+            discard_speculative_draft(section)
+
+# 현재 섹션이 저장되어 있고 다음 섹션이 비어 있으면 다음 섹션 초안을 백그라운드에서 미리 생성
+def schedule_next_section_draft(current_section):
+    if not st.session_state.get('speculative_generation', False) or not st.session_state.get('anthropic_client'):
+        return
+    if current_section not in RESEARCH_SECTIONS[:-1] or not load_section_content(current_section):
+        return
+    section = RESEARCH_SECTIONS[RESEARCH_SECTIONS.index(current_section) + 1]
+    if load_section_content(section):
+        return
+    if section == "2. 연구 배경" and not st.session_state.get('pdf_handles'):
+        return
+
+    drafts = st.session_state.setdefault('speculative_drafts', {})
+    fingerprint = speculative_fingerprint(section)
+    if section in drafts and drafts[section]["fingerprint"] == fingerprint:
+        return
+    discard_speculative_draft(section)
+
+    try:
+        prompt, context_sections = build_section_prompt(section)
+    except Exception as e:
+        print(f"Error preparing speculative draft for {section}: {str(e)}")
+        return
+    future = get_speculative_executor().submit(
+        run_with_script_run_ctx, get_script_run_ctx(), generate_section_draft, section, prompt, context_sections
+    )
+    drafts[section] = {"fingerprint": fingerprint, "future": future}
+
+# 다음 섹션으로 이동할 때 미리 생성된 초안이 있으면 바로 저장해서 보여줌
+# 입력이 바뀌었거나 생성에 실패한 초안은 버리고 기존처럼 사용자가 직접 생성
+def apply_speculative_draft(section):
+    draft = st.session_state.get('speculative_drafts', {}).pop(section, None)
+    if draft is None:
+        return
+    if load_section_content(section) or draft["fingerprint"] != speculative_fingerprint(section):
+        draft["future"].cancel()
+        return
+    try:
+        with st.spinner("미리 생성 중인 초안을 불러오는 중..."):
+            content = draft["future"].result(timeout=SPECULATIVE_WAIT_SECONDS)
+    except Exception as e:
+        print(f"Speculative draft for {section} discarded: {str(e)}")
+        return
+    if content:
+        save_generated_section(section, content)
+
 # 전체 인터페이스
 def chat_interface():
     st.subheader("IRB 연구계획서 작성 도우미✏️ ver.02 (by HJY)")
@@ -1867,6 +3823,49 @@ def chat_interface():
                 del st.session_state[key]
             st.rerun()
 
+        # 동일한 요청이라도 캐시된 응답 대신 새 초안을 받고 싶을 때 사용
+        st.sidebar.checkbox(
+            "🔁 캐시 무시하고 AI 응답 새로 생성",
+            key="bypass_llm_cache",
+            help="같은 입력으로 다시 요청하면 저장된 응답을 바로 보여줍니다. 새로운 초안이 필요하면 체크하세요."
+        )
+
+        # 수정 요청 시 바뀌는 구간만 받아 적용 (끄면 매번 섹션 전체를 다시 작성)
+        st.sidebar.checkbox(
+            "✂️ 부분 수정 모드",
+            value=True,
+            key="diff_revision_mode",
+            help="수정 요청을 제출하면 바꿀 문장만 받아 현재 내용에 적용하므로 작은 수정이 빠르게 끝납니다. 적용할 수 없으면 자동으로 전체를 다시 작성합니다."
+        )
+
+        # 섹션을 저장하면 다음 섹션 초안을 백그라운드에서 미리 생성
+        st.sidebar.checkbox(
+            "⚡ 다음 섹션 미리 생성",
+            value=False,
+            key="speculative_generation",
+            help="현재 섹션이 저장되면 다음 섹션 초안을 미리 만들어 두었다가 '다음 섹션' 버튼을 누를 때 바로 보여줍니다. 앞 섹션 내용이 바뀌면 미리 만든 초안은 버려집니다. API 사용량이 늘어날 수 있습니다."
+        )
+
+        # 최근 호출의 프롬프트 캐시 적중/미스 토큰 표시
+        if st.session_state.get('llm_usage_log'):
+            with st.sidebar.expander("📊 프롬프트 캐시 사용량"):
+                for entry in reversed(st.session_state.llm_usage_log):
+                    st.caption(
+                        f"{entry['label']}: 캐시 적중 {entry['cache_read_input_tokens']} / "
+                        f"캐시 저장 {entry['cache_creation_input_tokens']} / "
+                        f"일반 입력 {entry['input_tokens']} / 출력 {entry['output_tokens']} 토큰"
+                    )
+
+        # 호출 위치(라우트)별 모델, 평균 지연 시간, 누적 비용 표시
+        if st.session_state.get('llm_route_stats'):
+            with st.sidebar.expander("⏱️ 모델 라우트별 통계"):
+                for route, stats in st.session_state.llm_route_stats.items():
+                    st.caption(
+                        f"{route} ({stats['model']}): {stats['calls']}회 / "
+                        f"평균 {stats['latency_seconds'] / stats['calls']:.1f}초 / "
+                        f"누적 ${stats['cost_usd']:.4f}"
+                    )
+
         if st.sidebar.button("새 연구계획서 시작"):
             reset_session_state()
             st.success("새로운 연구계획서를 시작합니다.")
@@ -1902,6 +3901,66 @@ def render_home_page():
             st.session_state.current_section = section
             st.rerun()
 
+    # 전체 연구계획서 일괄 생성
+    st.markdown("---")
+    with st.expander("⚡ 전체 연구계획서 초안 한 번에 생성하기", expanded=False):
+        st.markdown("""연구 목적에 대한 입력과 `2. 연구 배경`에서 업로드한 참고논문 PDF를 바탕으로 모든 섹션의 초안을 순서대로 생성합니다.
+
+참고문헌 정리는 섹션 생성과 동시에 진행되며, 모든 섹션이 완성되면 전체 점검 피드백까지 받아 둡니다.""")
+        pipeline_input = st.text_area(
+            "연구 주제, 키워드 또는 introduction 원문을 입력하세요 (`1. 연구 목적`이 이미 저장되어 있다면 비워두어도 됩니다):",
+            height=150,
+            key="pipeline_user_input"
+        )
+        overwrite = st.checkbox("이미 작성된 섹션도 새로 생성하기", key="pipeline_overwrite")
+        if st.button("전체 초안 생성 시작🚀", key="run_protocol_pipeline"):
+            status, errors = run_protocol_pipeline(pipeline_input, overwrite)
+            if errors:
+                st.warning("일부 단계가 완료되지 않았습니다. 해당 섹션 페이지에서 직접 작성하거나 다시 시도해주세요.")
+            else:
+                st.success("전체 연구계획서 초안이 생성되었습니다. 사이드바의 '작성된 전체 연구계획서 내용 보기'에서 확인하세요.")
+
+    # 여러 연구계획서 일괄 생성 (Message Batches)
+    with st.expander("🗂️ 여러 연구계획서 일괄 생성하기 (Batch)", expanded=False):
+        st.markdown("""여러 연구 주제의 초안을 한꺼번에 배치 작업으로 생성합니다. 대화형 호출보다 느리지만(최대 수 시간) 비용이 절반 수준입니다.
+
+섹션 순서대로 한 단계씩 제출되며, `2. 연구 배경`은 참고논문 PDF가 필요하므로 각 연구계획서를 열어 직접 작성해주세요.""")
+        batch_topics = st.text_area("연구 주제를 한 줄에 하나씩 입력하세요:", height=150, key="batch_topics")
+        backend = st.selectbox(
+            "배치 백엔드",
+            list(BATCH_BACKENDS),
+            format_func=lambda name: BATCH_BACKENDS[name]["label"],
+            key="batch_backend"
+        )
+        if st.button("일괄 작업 제출📦", key="submit_batch_job"):
+            topics = [line.strip() for line in batch_topics.splitlines() if line.strip()]
+            if not topics:
+                st.warning("연구 주제를 한 개 이상 입력해주세요.")
+            else:
+                try:
+                    job = create_batch_job(topics, backend)
+                    st.success(f"일괄 작업 {job['job_id']}을 제출했습니다. ({len(topics)}건)")
+                except Exception as e:
+                    st.error(f"일괄 작업 제출 중 오류 발생: {str(e)}")
+
+        for job in load_batch_jobs(hash_api_key(st.session_state.get('api_key') or "")):
+            stage_label = "완료" if job["status"] == "done" else f"{BATCH_SECTIONS[job['stage']]} 처리 중"
+            st.markdown(f"**{job['job_id']}** ({BATCH_BACKENDS[job['backend']]['label']}) — {stage_label}, 오류 {len(job['errors'])}건")
+            if st.button("상태 확인 및 결과 반영🔄", key=f"poll_batch_{job['job_id']}"):
+                try:
+                    poll_batch_job(job)
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"일괄 작업 확인 중 오류 발생: {str(e)}")
+            for project in job["projects"]:
+                done_count = len(job["results"].get(project["research_id"], {}))
+                col1, col2 = st.columns([3, 1])
+                col1.caption(f"{project['topic'][:40]} — {done_count}/{len(BATCH_SECTIONS)} 섹션")
+                if col2.button("열기", key=f"open_batch_{project['research_id']}"):
+                    restore_batch_results(job)
+                    st.session_state.current_research_id = project["research_id"]
+                    st.rerun()
+
 def render_section_page():
     # 현재 섹션에 따른 작성 인터페이스 표시
     if st.session_state.current_section == "7. 연구 과제명":
@@ -1922,6 +3981,8 @@ def render_section_page():
     elif st.session_state.current_section == "6. 연구방법":
         write_research_method()
 
+    schedule_next_section_draft(st.session_state.current_section)
+
     # 이전 섹션과 다음 섹션 버튼
     col1, col2 = st.columns(2)
     
@@ -1940,6 +4001,7 @@ def render_section_page():
                 current_index = RESEARCH_SECTIONS.index(st.session_state.current_section)
                 if current_index < len(RESEARCH_SECTIONS) - 1:
                     st.session_state.current_section = RESEARCH_SECTIONS[current_index + 1]
+                    apply_speculative_draft(st.session_state.current_section)
                     st.rerun()
 
     # 홈으로 돌아가기 버튼
@@ -1954,6 +4016,36 @@ def calculate_dynamic_height(text, char_per_line=50, line_height=20, base_paddin
     calculated_height = (lines * line_height) + base_padding  # 줄 높이에 패딩 추가
     return max(calculated_height, min_height)  # 최소 높이 보장
 
+# AI 피드백(수정 제안 목록)을 카드 형태로 표시
+def render_review_feedback(feedback_items):
+    for item in feedback_items:
+        section_name = item.get('section')
+        reason_text = item.get('reason', '').strip()
+        original_text = item.get('original', '').strip()
+        suggestion_text = item.get('suggestion', '').strip()
+
+        # 섹션 이름이 없거나 수정 이유와 같은 필수 항목이 없는 경우 표시하지 않음
+        if not section_name or not reason_text:
+            continue
+
+        # 카드 형태로 피드백 표시
+        st.markdown(f"""
+        <div style="border: 1px solid #ddd; padding: 10px; margin-bottom: 20px; border-radius: 5px;">
+            <h5 style="margin: 0;">섹션 이름: {section_name}</h5>
+            <p><strong>수정 이유:</strong> {reason_text}</p>
+            <div style="display: flex; justify-content: space-between; align-items: stretch;">
+                <div style="flex: 1; background-color: #f9f9f9; padding: 10px; margin-right: 10px; border: 1px solid #ddd; border-radius: 5px;">
+                    <strong>기존 문장:</strong>
+                    <p>{original_text or '없음'}</p>
+                </div>
+                <div style="flex: 1; background-color: #e6f7ff; padding: 10px; border: 1px solid #ddd; border-radius: 5px;">
+                    <strong>수정 예시:</strong>
+                    <p>{suggestion_text or '없음'}</p>
+                </div>
+            </div>
+        </div>
+        """, unsafe_allow_html=True)
+
 def render_preview_mode():
     st.markdown("## 전체 연구계획서 미리보기")
     st.markdown("각 섹션의 내용은 편집 가능합니다.")
@@ -2027,12 +4119,20 @@ def render_preview_mode():
 
     # 기존 피드백 유지
     if "review_feedback" not in st.session_state:
-        st.session_state.review_feedback = ""
+        st.session_state.review_feedback = []
 
     if st.button("연구계획서 피드백 요청하기 🛠️", key="review_research_plan"):
         if not st.session_state.get("review_clicked", False):
             st.session_state.review_clicked = True
-            feedback = review_full_research_plan()  # 피드백 생성
+            # 섹션별 검토가 끝나는 대로 피드백을 먼저 보여줌
+            live_slot = st.empty()
+            live_feedback = live_slot.container()
+            live_feedback.markdown("#### AI 피드백 (검토 진행 중)")
+            def show_shard_feedback(section, shard_items):
+                with live_feedback:
+                    render_review_feedback(shard_items)
+            feedback = review_full_research_plan(on_shard_done=show_shard_feedback)  # 피드백 생성
+            live_slot.empty()
             st.session_state.review_feedback = feedback  # 피드백 저장
         else:
             st.warning("점검 요청이 이미 진행되었습니다. 새로고침 후 다시 시도하세요.")
@@ -2040,49 +4140,10 @@ def render_preview_mode():
     # 피드백 표시
     if st.session_state.review_feedback:
         st.markdown("#### AI 피드백")
-        feedback_data = st.session_state.review_feedback.split("\n\n")  # 피드백을 개별 섹션으로 분리
-
-        for feedback in feedback_data:
-            # 섹션 이름 추출
-            section_match = re.search(r"<섹션 이름>:\s*(.+)", feedback)
-            section_name = section_match.group(1) if section_match else None
-
-            # 수정 이유 추출
-            reason_match = re.search(r"수정 이유:\s*(.+)", feedback)
-            reason_text = reason_match.group(1).strip() if reason_match else None
-
-            # 기존 문장 추출
-            original_match = re.search(r"기존 문장:\s*```([^`]+)```", feedback, re.DOTALL)
-            original_text = original_match.group(1).strip() if original_match else None
-
-            # 수정 예시 추출
-            suggestion_match = re.search(r"수정 예시:\s*```([^`]+)```", feedback, re.DOTALL)
-            suggestion_text = suggestion_match.group(1).strip() if suggestion_match else None
-
-            # 섹션 이름이 없거나 수정 이유와 같은 필수 항목이 없는 경우 표시하지 않음
-            if not section_name or not reason_text:
-                continue
-
-            # 카드 형태로 피드백 표시
-            st.markdown(f"""
-            <div style="border: 1px solid #ddd; padding: 10px; margin-bottom: 20px; border-radius: 5px;">
-                <h5 style="margin: 0;">섹션 이름: {section_name}</h5>
-                <p><strong>수정 이유:</strong> {reason_text}</p>
-                <div style="display: flex; justify-content: space-between; align-items: stretch;">
-                    <div style="flex: 1; background-color: #f9f9f9; padding: 10px; margin-right: 10px; border: 1px solid #ddd; border-radius: 5px;">
-                        <strong>기존 문장:</strong>
-                        <p>{original_text or '없음'}</p>
-                    </div>
-                    <div style="flex: 1; background-color: #e6f7ff; padding: 10px; border: 1px solid #ddd; border-radius: 5px;">
-                        <strong>수정 예시:</strong>
-                        <p>{suggestion_text or '없음'}</p>
-                    </div>
-                </div>
-            </div>
-            """, unsafe_allow_html=True)
+        render_review_feedback(st.session_state.review_feedback)
          # 디버깅을 위한 AI 생성 피드백 원문 표시
         with st.expander("AI 생성 피드백 원문 보기"):
-            st.text_area("", value=st.session_state.review_feedback, height=300)
+            st.text_area("", value=json.dumps(st.session_state.review_feedback, ensure_ascii=False, indent=2), height=300)
 
 
     # 초기화 버튼 설명
@@ -2091,7 +4152,7 @@ def render_preview_mode():
     # 추가로, 필요 시 상태를 초기화할 수 있는 버튼 추가
     if st.button("피드백 상태 초기화 ♻️", key="reset_review_state"):
         st.session_state.review_clicked = False
-        st.session_state.review_feedback = ""
+        st.session_state.review_feedback = []
         st.success("피드백 상태가 초기화되었습니다. 다시 요청할 수 있습니다.")
 
     # 전체 내용 DOCX파일로 내보내기 
@@ -2187,7 +4248,7 @@ def generate_full_content():
         sections_content["참고문헌"] = references_content
     else:
         # 기존 PDF 파일에서 참고문헌을 생성하는 로직 유지
-        references = format_references(st.session_state.get('pdf_files', []))
+        references = format_references(st.session_state.get('pdf_handles', []))
         sections_content["참고문헌"] = "\n".join(references)
         # 참고문헌 세션 상태에 저장
         save_section_content("참고문헌", sections_content["참고문헌"])
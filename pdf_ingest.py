@@ -0,0 +1,363 @@
+# PDF 텍스트 추출 작업 프로세스에서 실행하는 함수
+# Streamlit이 실행하는 app.py의 함수는 작업 프로세스에서 pickle로 불러올 수 없어 별도 모듈로 분리
+import io
+import math
+import mmap
+import re
+from collections import Counter
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import LAParams, LTChar, LTTextContainer, LTTextLine
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
+from pdfminer.utils import decode_text
+
+# 앞쪽에서 초록/서론을 찾을 최대 페이지 수, 뒤쪽에서 결론을 찾을 최대 페이지 수
+HEAD_MAX_PAGES = 3
+TAIL_MAX_PAGES = 8
+
+# 추출 결과(텍스트, 제목 색인, 서지 정보) 형식 버전 (바뀌면 디스크에 저장된 추출 결과를 다시 만듦)
+PDF_DOCUMENT_VERSION = 6
+
+# 결론 제목 ("Discussion and Conclusion", "Conclusions and future work", "결론 및 제언" 같은 복합 제목 포함)
+CONCLUSION_TITLE = (
+    r'(?:(?:discussion|summary)[ \t]+(?:and|&)[ \t]+)?(?:conclusions?|concluding[ \t]+remarks)(?:[ \t]+(?:and|&)[ \t]+[a-z]+(?:[ \t]+[a-z]+){0,3})?|'
+    r'(?:고[ \t]*찰[ \t]*및[ \t]*)?결[ \t]*론(?:[ \t]*및[ \t]*[가-힣]+(?:[ \t]+[가-힣]+){0,2})?'
+)
+
+# 서론/결론/참고문헌 제목 줄 (제목만 단독으로 있는 줄만 인정하여 "Conclusion of the trial ..." 같은 본문 줄은 제외)
+INTRODUCTION_HEADING = re.compile(r'(?im)^[ \t]*(?:(?:[IVX]+|\d+(?:\.\d+)*)[.)]?[ \t]+)?(?:introduction|서[ \t]*론)[ \t]*[:.]?[ \t]*$')
+CONCLUSION_HEADING = re.compile(r'(?im)^[ \t]*(?:(?:[IVX]+|\d+(?:\.\d+)*)[.)]?[ \t]+)?(?:' + CONCLUSION_TITLE + r')[ \t]*[:.]?[ \t]*$')
+REFERENCES_HEADING = re.compile(r'(?im)^[ \t]*(?:(?:[IVX]+|\d+(?:\.\d+)*)[.)]?[ \t]+)?(?:references|bibliography|참[ \t]*고[ \t]*문[ \t]*헌)[ \t]*[:.]?[ \t]*$')
+# 결론 제목을 찾지 못했을 때 남길 뒤쪽 본문 페이지 수
+TAIL_FALLBACK_PAGES = 2
+
+# 페이지 하나만 레이아웃 분석
+def render_page(interpreter, device, page):
+    interpreter.process_page(page)
+    return device.get_result()
+
+def layout_text(layout):
+    return "".join(element.get_text() for element in layout if isinstance(element, LTTextContainer))
+
+def render_page_text(interpreter, device, page):
+    return layout_text(render_page(interpreter, device, page))
+
+# PDF 문서, 페이지 목록, 페이지 렌더링에 쓸 인터프리터/장치 (data는 bytes 또는 mmap)
+def open_pdf_pages(data):
+    stream = io.BytesIO(data) if isinstance(data, bytes) else data
+    document = PDFDocument(PDFParser(stream))
+    pages = list(PDFPage.create_pages(document))
+    resource_manager = PDFResourceManager()
+    device = PDFPageAggregator(resource_manager, laparams=LAParams())
+    interpreter = PDFPageInterpreter(resource_manager, device)
+    return document, pages, interpreter, device
+
+# 전체 문서를 렌더링하지 않고 필요한 페이지만 추출
+# 앞쪽은 서론 제목이 나온 다음 페이지까지(최대 HEAD_MAX_PAGES), 뒤쪽은 끝에서부터 결론 제목이 있는 페이지를 찾아
+# 그 페이지와 다음 페이지만 남김 (참고문헌, 부록 페이지는 결론을 찾는 동안만 읽고 버림)
+# 결론 제목이 없으면 참고문헌 제목이 있는 페이지와 그 앞 페이지(본문의 마지막 부분)를 남기고,
+# 참고문헌 제목도 없으면 읽은 뒤쪽 페이지 중 가장 앞쪽 TAIL_FALLBACK_PAGES개를 남김
+# data는 바이트 또는 seek/read가 가능한 파일 객체(mmap 포함)
+# 반환값: {"document": PDFDocument, "first_page": 첫 페이지 레이아웃, "text": 추출한 텍스트,
+#         "pages": 남긴 페이지 텍스트 목록, "rendered_pages": 읽은 모든 페이지 텍스트 목록}
+def read_key_pages(data, head_max_pages=HEAD_MAX_PAGES, tail_max_pages=TAIL_MAX_PAGES):
+    document, pages, interpreter, device = open_pdf_pages(data)
+
+    texts = {}
+    first_page = None
+    introduction_page = None
+    for index in range(min(head_max_pages, len(pages))):
+        layout = render_page(interpreter, device, pages[index])
+        if index == 0:
+            first_page = layout
+        texts[index] = layout_text(layout)
+        if introduction_page is not None:
+            break
+        if INTRODUCTION_HEADING.search(texts[index]):
+            introduction_page = index
+    head_end = max(texts) if texts else -1
+
+    kept = set(texts)
+    tail_texts = {}
+    conclusion_page = None
+    references_page = None
+    for index in range(len(pages) - 1, max(head_end, len(pages) - 1 - tail_max_pages), -1):
+        tail_texts[index] = render_page_text(interpreter, device, pages[index])
+        if CONCLUSION_HEADING.search(tail_texts[index]):
+            conclusion_page = index
+            break
+        if REFERENCES_HEADING.search(tail_texts[index]):
+            references_page = index
+    if conclusion_page is not None:
+        kept.update(i for i in (conclusion_page, conclusion_page + 1) if i in tail_texts)
+    elif references_page is not None:
+        body_page = references_page - 1
+        if body_page > head_end and body_page not in tail_texts:
+            tail_texts[body_page] = render_page_text(interpreter, device, pages[body_page])
+        kept.update(i for i in (body_page, references_page) if i in tail_texts)
+    else:
+        kept.update(sorted(tail_texts)[:TAIL_FALLBACK_PAGES])
+    texts.update(tail_texts)
+    kept_pages = [texts[index] for index in sorted(kept)]
+    return {
+        "document": document,
+        "first_page": first_page,
+        "text": "\x0c".join(kept_pages),
+        "pages": kept_pages,
+        "rendered_pages": [texts[index] for index in sorted(texts)],
+    }
+
+def extract_key_pages_text(data, head_max_pages=HEAD_MAX_PAGES, tail_max_pages=TAIL_MAX_PAGES):
+    return read_key_pages(data, head_max_pages, tail_max_pages)["text"]
+
+# 추출 텍스트 정리 설정
+# 페이지 위/아래에서 머리글/바닥글 후보로 볼 줄 수, 반복되는 머리글/바닥글로 판단할 최소 페이지 비율
+RUNNING_LINE_EDGE_LINES = 3
+RUNNING_LINE_MIN_PAGE_RATIO = 0.5
+# 합자(ﬁ, ﬂ 등)와 소프트 하이픈
+LIGATURE_TABLE = str.maketrans({
+    "\ufb00": "ff", "\ufb01": "fi", "\ufb02": "fl", "\ufb03": "ffi", "\ufb04": "ffl",
+    "\ufb05": "st", "\ufb06": "st", "\u00ad": "",
+})
+CID_ARTIFACT_PATTERN = re.compile(r'\(cid:\d+\)')
+PAGE_NUMBER_LINE_PATTERN = re.compile(r'(?i)^(?:page\s*)?\d{1,4}(?:\s*(?:/|of)\s*\d{1,4})?$')
+# 줄 끝에서 하이픈으로 나뉜 영어 단어 (다음 줄이 소문자로 시작할 때만 이어 붙임)
+HYPHENATED_LINE_BREAK_PATTERN = re.compile(r'([A-Za-z])-\n([a-z]+)[ \t]*')
+
+# 대략적인 토큰 수 (영문은 약 4자당 1토큰, 한글 등 비ASCII 문자는 1자당 약 1토큰, app.estimate_tokens와 공유)
+def estimate_text_tokens(text):
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return (len(text) - non_ascii) // 4 + non_ascii
+
+# 페이지 번호 등 숫자만 다른 머리글/바닥글을 같은 줄로 보기 위한 비교 키
+def running_line_key(line):
+    return re.sub(r'\d+', '#', " ".join(line.lower().split()))
+
+# 페이지 위/아래 가장자리의 줄 번호
+def edge_line_indexes(lines):
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    return set(filled[:RUNNING_LINE_EDGE_LINES] + filled[-RUNNING_LINE_EDGE_LINES:])
+
+# 여러 페이지의 가장자리에 반복해서 나오는 줄(저널 이름, 저자 약칭, DOI 바닥글 등) 찾기
+def find_running_lines(pages):
+    if len(pages) < 2:
+        return set()
+    counts = Counter()
+    for page in pages:
+        lines = page.translate(LIGATURE_TABLE).split("\n")
+        counts.update({running_line_key(lines[i]) for i in edge_line_indexes(lines)})
+    min_pages = max(2, math.ceil(len(pages) * RUNNING_LINE_MIN_PAGE_RATIO))
+    return {key for key, count in counts.items() if count >= min_pages}
+
+# 페이지 하나 정리: 합자/깨진 글자 복원, 머리글/바닥글과 쪽 번호 제거, 줄바꿈 하이픈 연결, 공백 정리
+def compact_page(page, running_lines):
+    lines = CID_ARTIFACT_PATTERN.sub("", page.translate(LIGATURE_TABLE)).split("\n")
+    edges = edge_line_indexes(lines)
+    kept = []
+    for i, line in enumerate(lines):
+        line = " ".join(line.split())
+        if i in edges and (running_line_key(line) in running_lines or PAGE_NUMBER_LINE_PATTERN.match(line)):
+            continue
+        kept.append(line)
+    page = HYPHENATED_LINE_BREAK_PATTERN.sub(r'\1\2\n', "\n".join(kept))
+    return re.sub(r'\n{3,}', "\n\n", page).strip()
+
+# 페이지를 하나씩 정리해서 돌려줌 (running_lines는 find_running_lines 결과)
+def compact_pages(pages, running_lines):
+    for page in pages:
+        yield compact_page(page, running_lines)
+
+# 섹션 제목 줄 (번호/대소문자 변형 포함, 제목만 단독으로 있는 줄만 인정하여 본문 속 단어는 제외)
+# 페이지 구분 문자(\x0c) 바로 뒤나 앞에 있는 페이지 맨 위/아래 제목도 한 줄로 인정
+HEADING_LINE = re.compile(
+    r'(?im)(?:^|(?<=\x0c))[ \t]*(?:(?:[IVX]+|\d+(?:\.\d+)*)[.)]?[ \t]+)?'
+    r'(abstract|summary|introduction|materials?[ \t]+and[ \t]+methods|methods?|results|discussion|'
+    r'conclusions?|concluding[ \t]+remarks|references|bibliography|' + CONCLUSION_TITLE + r'|'
+    r'초[ \t]*록|요[ \t]*약|서[ \t]*론|연구[ \t]*방법|방[ \t]*법|결[ \t]*과|고[ \t]*찰|결[ \t]*론|참[ \t]*고[ \t]*문[ \t]*헌)'
+    r'[ \t]*[:.]?[ \t]*(?=[\r\n\x0c]|\Z)'
+)
+
+HEADING_NAMES = {
+    "abstract": "abstract", "summary": "abstract", "초록": "abstract", "요약": "abstract",
+    "introduction": "introduction", "서론": "introduction",
+    "materialsandmethods": "methods", "materialandmethods": "methods", "methods": "methods", "method": "methods",
+    "연구방법": "methods", "방법": "methods",
+    "results": "results", "결과": "results",
+    "discussion": "discussion", "고찰": "discussion",
+    "conclusion": "conclusion", "conclusions": "conclusion", "concludingremarks": "conclusion", "결론": "conclusion",
+    "references": "references", "bibliography": "references", "참고문헌": "references",
+}
+
+# 제목 줄의 섹션 이름 ("Discussion and Conclusion" 같은 복합 결론 제목은 conclusion)
+def heading_name(title):
+    key = re.sub(r'\s+', '', title.lower())
+    return HEADING_NAMES.get(key) or "conclusion"
+
+# 텍스트를 한 번만 훑어 섹션 제목 위치 색인 생성: {섹션 이름: [[시작, 끝], ...]}
+# 각 구간은 제목 줄부터 다음 제목 직전까지이며, 첫 제목 앞부분은 "front"로 저장
+def build_heading_index(text):
+    matches = [(match.start(), heading_name(match.group(1))) for match in HEADING_LINE.finditer(text)]
+    index = {}
+    if matches and matches[0][0] > 0:
+        index["front"] = [[0, matches[0][0]]]
+    for i, (start, name) in enumerate(matches):
+        end = matches[i + 1][0] if i + 1 < len(matches) else len(text)
+        index.setdefault(name, []).append([start, end])
+    return index
+
+# 로컬 서지 정보 추출 설정 (PDF Info/XMP 메타데이터, DOI, 첫 페이지 글자 크기, 한국 소속 판별)
+DOI_PATTERN = re.compile(r'\b(10\.\d{4,9}/[^\s"<>]+[^\s"<>.,;])')
+HANGUL_PATTERN = re.compile(r'[\uac00-\ud7a3]')
+KOREAN_AFFILIATION_PATTERN = re.compile(
+    r'(?i)\b(korea|seoul|busan|pusan|daegu|incheon|gwangju|daejeon|ulsan|suwon|seongnam|goyang|gyeonggi|'
+    r'gangwon|chungbuk|chungnam|jeonbuk|jeonnam|gyeongbuk|gyeongnam|jeju|cheongju|chuncheon|wonju)\b'
+)
+AFFILIATION_LINE_PATTERN = re.compile(r'(?i)(universit|hospital|college|institute|department|dept\.|school of|center|centre|대학|병원|연구소)')
+PUBLISHED_YEAR_PATTERN = re.compile(r'(?i)(?:published(?: online)?|accepted|©|copyright|\(c\))[^\n\d]{0,40}((?:19|20)\d{2})')
+PLACEHOLDER_TITLE_PATTERN = re.compile(r'(?i)(untitled|microsoft word|\.docx?$|\.pdf$|\.tex$|^doi:)')
+# 작성 프로그램/계정/출판사 이름 등 저자가 아닌 Author 값
+PLACEHOLDER_AUTHOR_PATTERN = re.compile(
+    r'(?i)^(?:admin(?:istrator)?|user|owner|author|unknown|anonymous|guest|pc|default|editor|staff)\d*$|'
+    r'\b(?:microsoft|adobe|elsevier|springer|wiley|taylor|francis|sage|oxford|cambridge|nature|lippincott|'
+    r'wolters|kluwer|karger|thieme|mdpi|frontiers|ieee|publish\w*|journal|press|inc|ltd|corp\w*)\b|\.com|@'
+)
+XMP_TITLE_PATTERN = re.compile(r'<dc:title>.*?<rdf:li[^>]*>(.*?)</rdf:li>', re.DOTALL)
+XMP_CREATOR_PATTERN = re.compile(r'<dc:creator>(.*?)</dc:creator>', re.DOTALL)
+XMP_LIST_ITEM_PATTERN = re.compile(r'<rdf:li[^>]*>(.*?)</rdf:li>', re.DOTALL)
+XMP_DOI_PATTERN = re.compile(r'<(?:prism:doi|dc:identifier)[^>]*>(?:doi:)?(10\.[^<]+)<')
+XMP_DATE_PATTERN = re.compile(r'<(?:prism:publicationDate|prism:coverDate)[^>]*>((?:19|20)\d{2})')
+
+def metadata_field(value, confidence, source):
+    return {"value": value, "confidence": confidence, "source": source}
+
+# PDF Info 사전의 값을 문자열로 변환
+def info_value(info, key):
+    value = resolve1(info.get(key))
+    if isinstance(value, bytes):
+        value = decode_text(value)
+    return value.strip() if isinstance(value, str) else ""
+
+def read_xmp(document):
+    try:
+        stream = resolve1(document.catalog.get("Metadata"))
+        return stream.get_data().decode("utf-8", "replace") if stream is not None else ""
+    except Exception:
+        return ""
+
+# 첫 페이지에서 글자 크기가 가장 큰 줄들을 제목 후보로 선택 (크기 차이가 뚜렷할수록 신뢰도 상승)
+def title_from_layout(first_page):
+    lines = []
+    def collect(element):
+        if isinstance(element, LTTextLine):
+            sizes = [char.size for char in element if isinstance(char, LTChar)]
+            text = element.get_text().strip()
+            if sizes and len(text) >= 3:
+                lines.append((round(sum(sizes) / len(sizes), 1), -element.y1, text))
+        elif hasattr(element, "__iter__"):
+            for child in element:
+                collect(child)
+    if first_page is not None:
+        collect(first_page)
+    if not lines:
+        return "", 0.0
+    sizes = sorted({size for size, _, _ in lines}, reverse=True)
+    title = " ".join(text for size, _, text in sorted(lines, key=lambda line: line[1]) if size == sizes[0])
+    if len(title) < 10 or len(title) > 300:
+        return title, 0.2
+    ratio = sizes[0] / sizes[1] if len(sizes) > 1 else 1.0
+    return title, 0.75 if ratio >= 1.2 else 0.4
+
+# 로컬 정보만으로 서지 정보와 항목별 신뢰도(0~1) 추출
+def extract_local_metadata(document, first_page, text):
+    info = document.info[0] if document.info else {}
+    xmp = read_xmp(document)
+    first_page_text = layout_text(first_page) if first_page is not None else text[:5000]
+    metadata = {}
+
+    # 제목: XMP/Info 제목이 그럴듯하면 우선 사용, 첫 페이지 글자 크기 결과와 일치하면 신뢰도 상승
+    layout_title, layout_confidence = title_from_layout(first_page)
+    xmp_title = XMP_TITLE_PATTERN.search(xmp)
+    declared_title = (xmp_title.group(1).strip() if xmp_title else "") or info_value(info, "Title")
+    if declared_title and len(declared_title) >= 10 and not PLACEHOLDER_TITLE_PATTERN.search(declared_title):
+        matches_layout = declared_title.lower()[:30] in layout_title.lower()
+        metadata["title"] = metadata_field(declared_title, 0.95 if matches_layout else 0.8, "pdf_metadata")
+    else:
+        metadata["title"] = metadata_field(layout_title, layout_confidence, "layout")
+
+    # 저자: XMP dc:creator 또는 Info Author
+    # 계정/프로그램/출판사 이름은 버리고, Info Author는 검증되지 않은 값이라 이름처럼 보여도 신뢰도를 낮게 둠
+    xmp_creator = XMP_CREATOR_PATTERN.search(xmp)
+    authors = [name.strip() for name in XMP_LIST_ITEM_PATTERN.findall(xmp_creator.group(1))] if xmp_creator else []
+    authors = [name for name in authors if not PLACEHOLDER_AUTHOR_PATTERN.search(name)]
+    confidence = 0.85
+    if not authors:
+        authors = [name.strip() for name in re.split(r';|,| and ', info_value(info, "Author")) if name.strip()]
+        authors = [name for name in authors if not PLACEHOLDER_AUTHOR_PATTERN.search(name)]
+        confidence = 0.75 if authors and all(len(name.split()) >= 2 for name in authors) else 0.5
+    metadata["authors"] = metadata_field(authors[:3], confidence if authors else 0.0, "pdf_metadata")
+
+    # 연도: 출판/승인/저작권 표기 > XMP 출판일 > 파일 생성일
+    published_year = PUBLISHED_YEAR_PATTERN.search(first_page_text)
+    xmp_year = XMP_DATE_PATTERN.search(xmp)
+    creation_year = re.match(r'D:((?:19|20)\d{2})', info_value(info, "CreationDate"))
+    if published_year:
+        metadata["year"] = metadata_field(published_year.group(1), 0.85, "text")
+    elif xmp_year:
+        metadata["year"] = metadata_field(xmp_year.group(1), 0.8, "pdf_metadata")
+    elif creation_year:
+        metadata["year"] = metadata_field(creation_year.group(1), 0.5, "creation_date")
+    else:
+        metadata["year"] = metadata_field("", 0.0, "none")
+
+    # DOI
+    doi = XMP_DOI_PATTERN.search(xmp) or DOI_PATTERN.search(first_page_text) or DOI_PATTERN.search(info_value(info, "Subject"))
+    metadata["doi"] = metadata_field(doi.group(1).strip() if doi else "", 0.9 if doi else 0.0, "text")
+
+    # 소속 및 한국 소속 여부: 소속 기관 줄에서 한국 지명 또는 한글이 보이면 한국 소속으로 판단
+    affiliations = [line.strip() for line in first_page_text.splitlines() if AFFILIATION_LINE_PATTERN.search(line) and len(line.strip()) < 200]
+    metadata["affiliations"] = metadata_field(affiliations[:3], 0.6 if affiliations else 0.0, "text")
+    korean_evidence = any(KOREAN_AFFILIATION_PATTERN.search(line) or HANGUL_PATTERN.search(line) for line in affiliations)
+    if korean_evidence or HANGUL_PATTERN.search(first_page_text):
+        metadata["is_korean"] = metadata_field(True, 0.9, "text")
+    else:
+        metadata["is_korean"] = metadata_field(False, 0.75 if affiliations else 0.5, "text")
+    return metadata
+
+# 작업 프로세스에서 텍스트 추출, 텍스트 정리, 제목 색인 생성, 로컬 서지 정보 추출을 함께 수행 (캐시에 함께 저장)
+# 서지 정보는 DOI 바닥글 등이 남아 있는 정리 전 텍스트에서 찾음
+# compaction에는 정리 전후의 대략적인 토큰 수를 기록
+def extract_pdf_document(data):
+    pages = read_key_pages(data)
+    running_lines = find_running_lines(pages["rendered_pages"])
+    text = "\x0c".join(compact_pages(pages["pages"], running_lines))
+    try:
+        metadata = extract_local_metadata(pages["document"], pages["first_page"], pages["text"])
+    except Exception as e:
+        print(f"Error extracting local metadata: {str(e)}")
+        metadata = {}
+    return {
+        "text": text,
+        "headings": build_heading_index(text),
+        "metadata": metadata,
+        "compaction": {"original_tokens": estimate_text_tokens(pages["text"]), "compacted_tokens": estimate_text_tokens(text)},
+    }
+
+# 디스크에 저장된 PDF를 mmap으로 열어 추출 (파일 전체를 작업 프로세스 메모리로 복사하지 않음)
+def extract_pdf_document_from_path(path):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return extract_pdf_document(data)
+
+# 모든 페이지의 정리된 본문과 섹션 제목 색인 (방법, 결과, 고찰 포함)
+# 핵심 페이지 추출보다 오래 걸리므로 업로드 후 백그라운드에서 따로 실행하여 근거 문단 검색에 사용
+def extract_pdf_body(data):
+    _, pages, interpreter, device = open_pdf_pages(data)
+    rendered_pages = [render_page_text(interpreter, device, page) for page in pages]
+    text = "\x0c".join(compact_pages(rendered_pages, find_running_lines(rendered_pages)))
+    return {"text": text, "headings": build_heading_index(text)}
+
+def extract_pdf_body_from_path(path):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return extract_pdf_body(data)